@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Utilities shared by the preprocessing, the training and the website to handle audio files
+"""
+from collections import namedtuple
+from pathlib import Path
+import numpy as np
+import scipy.signal
+import soundfile as sf
+from staging import replaced_file
+
+AudioInfo = namedtuple("AudioInfo", ["frames", "samplerate", "channels", "subtype", "duration"])
+
+def get_audio_info(audio_path) -> AudioInfo:
+    """
+    Returns the number of frames, the sampling rate, the number of channels,
+    the subtype and the duration (seconds) of the audio file
+
+    Only the header of the file is read, the audio is not decoded
+
+    audio_path: a Path, a path or a file-like object
+    """
+    info = sf.info(str(audio_path) if isinstance(audio_path, Path) else audio_path)
+    return AudioInfo(info.frames, info.samplerate, info.channels, info.subtype, info.frames / info.samplerate)
+
+def get_durations(folder: Path, pattern="**/*.wav") -> dict:
+    """
+    Returns a dict {audio file: duration} of the files of the folder
+    """
+    return {f: get_audio_info(f).duration for f in sorted(folder.glob(pattern)) if f.is_file()}
+
+def sum_stems(stem_paths: list, output_path: Path, blocksize=65536):
+    """
+    Writes the sum of the stems, reading and writing them block by block
+
+    The stems must have the same sampling rate, they are summed at this rate
+    without resampling. The shorter stems are zero padded and the mono stems
+    are added to every channel. PCM samples are summed as integers, the sum is
+    exact unless it overflows the output subtype (then it is clipped)
+
+    stem_paths: the stems to sum
+    output_path: the summed file, with the subtype of the first stem
+    blocksize: the number of frames read at once, the memory used is O(blocksize x stems)
+    """
+    stems = [sf.SoundFile(str(p)) for p in stem_paths]
+    try:
+        rates = {s.samplerate for s in stems}
+        if len(rates) > 1:
+            raise ValueError(f"The stems have different sampling rates: {sorted(rates)}")
+
+        channels = max(s.channels for s in stems)
+        frames = max(s.frames for s in stems)
+        subtype = stems[0].subtype
+
+        # integers are summed exactly in int64, float subtypes in float64
+        if subtype in ("FLOAT", "DOUBLE"):
+            read_dtype, sum_dtype, info = "float64", np.float64, None
+        else:
+            read_dtype, sum_dtype, info = "int32", np.int64, np.iinfo(np.int32)
+
+        total = np.zeros((blocksize, channels), dtype=sum_dtype)
+        buffers = [np.zeros((blocksize, s.channels), dtype=read_dtype) for s in stems]
+
+        with sf.SoundFile(str(output_path), "w", samplerate=rates.pop(), channels=channels, subtype=subtype) as output:
+            for start in range(0, frames, blocksize):
+                n = min(blocksize, frames - start)
+                total[:n] = 0
+                for stem, buffer in zip(stems, buffers):
+                    read = stem.read(n, dtype=read_dtype, always_2d=True, out=buffer[:n])
+                    # the mono stems are broadcast to the channels
+                    total[:len(read)] += read
+
+                block = total[:n]
+                if info is not None:
+                    block = np.clip(block, info.min, info.max).astype(np.int32)
+                output.write(block)
+    finally:
+        for s in stems:
+            s.close()
+
+    return output_path
+
+def convert_channels(block, channels):
+    """
+    Returns the block (frames, channels) with the target number of channels
+
+    The stems are averaged to mono and the mono stems duplicated to every channel
+    """
+    nb_channels = block.shape[1]
+    if nb_channels == channels:
+        return block
+    if channels == 1:
+        return block.mean(axis=1, keepdims=True)
+    return block[:, np.arange(channels) % nb_channels]
+
+def normalize_stem(stem_path: Path, output_path: Path = None, channels=None, samplerate=None,
+                   subtype=None, frames=None, blocksize=65536) -> bool:
+    """
+    Writes the stem with the target number of channels, sampling rate, subtype and
+    number of frames in a single pass, returns False if the stem already matches them
+
+    The stem is read and written block by block, except when it is resampled:
+    it is then decoded once and resampled at once (polyphase filtering).
+    The stem is replaced by default, through a temporary file so that a stem
+    linked to an original file never modifies the original (see staging.py)
+
+    channels, samplerate, subtype: the target format, unchanged if None
+    frames: the target number of frames at the target sampling rate,
+    the stem is cut or padded with zeros, unchanged if None
+    """
+    info = sf.info(str(stem_path))
+    channels = channels or info.channels
+    samplerate = samplerate or info.samplerate
+    subtype = subtype or info.subtype
+    resampled_frames = int(np.ceil(info.frames * samplerate / info.samplerate))
+    frames = resampled_frames if frames is None else frames
+
+    if output_path is None and (channels, samplerate, subtype, frames) == (info.channels, info.samplerate, info.subtype, info.frames):
+        return False
+
+    with sf.SoundFile(str(stem_path)) as f:
+        if samplerate != info.samplerate:
+            audio = f.read(dtype="float64", always_2d=True)
+            gcd = np.gcd(info.samplerate, samplerate)
+            audio = scipy.signal.resample_poly(audio, samplerate // gcd, info.samplerate // gcd, axis=0)
+            blocks = (audio[i:i + blocksize] for i in range(0, len(audio), blocksize))
+        else:
+            blocks = f.blocks(blocksize, dtype="float64", always_2d=True, frames=frames)
+
+        def write(path):
+            with sf.SoundFile(str(path), "w", samplerate=samplerate, channels=channels, subtype=subtype) as output:
+                written = 0
+                for block in blocks:
+                    block = block[:frames - written]
+                    output.write(convert_channels(block, channels))
+                    written += len(block)
+                    if written >= frames:
+                        break
+                # zero padding of the shorter stems
+                if written < frames:
+                    output.write(np.zeros((frames - written, channels)))
+
+        if output_path is None:
+            with replaced_file(stem_path) as tmp_path:
+                write(tmp_path)
+        else:
+            write(output_path)
+
+    return True
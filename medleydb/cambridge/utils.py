@@ -2,19 +2,18 @@
 """
 Utilities to use the Cambridge Music Technology audio files
 """
-from shutil import copytree
 from pathlib import Path
-import wave
-import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import re
 import scipy.signal
-from scipy.io import wavfile
-from librosa import load, get_samplerate, get_duration
 import numpy as np
 import pandas as pd
 import librosa
 import soundfile as sf
 from tqdm import tqdm
+from audio.utils import get_audio_info, normalize_stem
+from staging import link_tree
+from medleydb.activations import get_activation_files, get_presence_ratios, update_activation_index
 
 # data folder for the open-unmix model
 umx_data_path = Path("/media/mvitry/Windows/umx/data")
@@ -134,6 +133,133 @@ def compute_activation_confidence(track_path, win_len=4096, lpf_cutoff=0.075,
     C_out = np.vstack((time, C))
     return C_out.T
 
+def load_mono(track_path: Path, rate=44100):
+    """
+    Returns the mono signal of the track at the sampling rate
+    """
+    audio, sr = sf.read(str(track_path), dtype="float32", always_2d=True)
+    audio = audio.mean(axis=1)
+    if sr != rate:
+        gcd = np.gcd(sr, rate)
+        audio = scipy.signal.resample_poly(audio, rate // gcd, sr // gcd).astype(np.float32)
+    return audio
+
+def batch_track_energy(waves, win_len, win):
+    """Compute the energy of audio signals of the same length, same as track_energy
+    for each row of the matrix
+
+    Parameters
+    ----------
+    waves : np.array
+        The signals (n_stems, n_samples) from which to compute energy
+    win_len: int
+        The number of samples to use in energy computation
+    win : np.array
+        The windowing function to use in energy computation
+
+    Returns
+    -------
+    energy : np.array
+        Array of track energies (n_stems, n_frames)
+
+    """
+    hop_len = win_len // 2
+
+    # pre padding, then post padding to a multiple of win_len
+    n_samples = waves.shape[1] + win_len - hop_len
+    padded = np.zeros((waves.shape[0], int(win_len * np.ceil(n_samples / win_len))), dtype=waves.dtype)
+    padded[:, win_len - hop_len:n_samples] = waves
+
+    # Envelope follower: half-wave rectification + compression, in place on the signals
+    # before the framing, the overlapping frames are never copied
+    np.sqrt(np.maximum(padded, 0, out=padded), out=padded)
+
+    # cut into frames, strided views (n_stems, n_frames, win_len)
+    wavmat = np.lib.stride_tricks.sliding_window_view(padded, win_len, axis=1)[:, ::hop_len]
+
+    # windowed mean of each frame
+    return wavmat @ win.astype(padded.dtype) / win_len
+
+def batch_activation_confidence(track_paths, win_len=4096, lpf_cutoff=0.075,
+                                theta=0.15, var_lambda=20.0,
+                                amplitude_threshold=0.01, rate=44100):
+    """Create the activation confidence annotations of several stems, same as
+    compute_activation_confidence for each stem. The stems of the same length
+    are stacked and processed as one matrix
+
+    Parameters
+    ----------
+    track_paths : list
+        Path objects of the stems
+    rate : int, default=44100
+        The stems are resampled to this rate
+
+    Returns
+    -------
+    C : list
+        Arrays of activation confidence values (n_conf,), one per stem
+    """
+    # MATLAB equivalent to @hanning(win_len)
+    win = scipy.signal.windows.hann(win_len + 2)[1:-1]
+    b, a = scipy.signal.butter(2, lpf_cutoff, 'low')
+
+    audios = [load_mono(p, rate) for p in track_paths]
+
+    # grouping the stems by length
+    groups = {}
+    for i, audio in enumerate(audios):
+        groups.setdefault(len(audio), []).append(i)
+
+    C = [None] * len(audios)
+    for indexes in groups.values():
+        H = batch_track_energy(np.stack([audios[i] for i in indexes]), win_len, win)
+
+        # normalization of each stem to its overall energy
+        low_energy = H < amplitude_threshold
+        H /= np.max(H, axis=1, keepdims=True)
+        # binary thresholding for low overall energy events
+        H[low_energy] = 0.0
+
+        # LP filter
+        H = scipy.signal.filtfilt(b, a, H, axis=1)
+
+        # logistic function to semi-binarize the output; confidence value
+        confidences = 1.0 - (1.0 / (1.0 + np.exp(var_lambda * (H - theta))))
+        for i, c in zip(indexes, confidences):
+            C[i] = c
+
+    return C
+
+def save_activation(file_name: Path, confidence, rate=44100, hop_length=2048, lab=False):
+    """
+    Writes the activation confidence of a stem in a binary .npz file,
+    and in a text .lab file (time,stem) if lab is True
+    """
+    np.savez(file_name.with_suffix(".npz"), confidence=confidence.astype(np.float16), rate=rate, hop_length=hop_length)
+    if lab:
+        time = np.arange(len(confidence)) * hop_length / rate
+        np.savetxt(
+            file_name.with_suffix(".lab"),
+            np.vstack((time, confidence)).T,
+            header='time,{}'.format(file_name.stem),
+            delimiter=',',
+            fmt='%.4f',
+            comments=''
+            )
+
+def annotate_stems(track_paths, annotations_path: Path, lab=False, win_len=4096):
+    """
+    Computes and writes the activation files of the stems, returns their paths
+
+    Runs in a worker process
+    """
+    files = []
+    for track_path, confidence in zip(track_paths, batch_activation_confidence(track_paths, win_len=win_len)):
+        file_name = annotations_path.joinpath(f"{track_path.name.split('.wav')[0]}.npz")
+        save_activation(file_name, confidence, hop_length=win_len // 2, lab=lab)
+        files.append(file_name)
+    return files
+
 def get_instruments(audio_path: Path) -> list: 
     """
     Return the list of unique instruments names in the files
@@ -148,39 +274,40 @@ def get_instrument_ratio(activation_path: Path) -> dict:
     Returns a dict {stem: percentage}
     of the ratio of presence of the instrument in the stem
 
-    activation_path: the activation files path
+    activation_path: the activation file path, binary .npz or text .lab
     """
-    stem_name = activation_path.name.split('.lab')[0]
+    stem_name = activation_path.stem
 
-    dfx = pd.read_csv(activation_path)
+    if activation_path.suffix == ".npz":
+        confidence = np.load(activation_path)["confidence"]
+    else:
+        confidence = pd.read_csv(activation_path)[stem_name].values
     
     # ratio of the presence of the instrument in the stem
-    presence_ratio = (dfx[stem_name] > 0.5).value_counts(True)[1]
+    presence_ratio = np.mean(confidence > 0.5)
     
     return {stem_name: presence_ratio}
 
-def create_activation_files(target_tracks: list) -> list:
+def create_activation_files(target_tracks: list, annotations_path: Path, lab=False, nb_workers=None, batch_size=16) -> list:
     """
     Returns the list of the activation files created
 
-    target_tracks: list of Path to the tracks to annotate
+    The stems are annotated by batches of batch_size stems on nb_workers processes,
+    the activations are written in binary .npz files and in .lab files if lab is True
+
+    target_tracks: list of (index, Path) of the tracks to annotate
+    annotations_path: the folder of the activation files
     """
+    track_paths = [track[1] for track in target_tracks]
+    batches = [track_paths[i:i + batch_size] for i in range(0, len(track_paths), batch_size)]
+
     created_files = []
     print("\nCreating activation files...\n")
-    for track in tqdm(target_tracks):
-        track_name = track[1].name.split('.wav')[0]
-        print(f"{track[0]}: {track_name}")
-        activations = compute_activation_confidence(track[1])
-        file_name = audio_path.parent.joinpath("annotations", f"{track_name}.lab")
-        np.savetxt(
-            file_name,
-            activations,
-            header='time,{}'.format(track_name),
-            delimiter=',',
-            fmt='%.4f',
-            comments=''
-            )
-        created_files.append(file_name)
+    annotations_path.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(nb_workers) as executor:
+        futures = [executor.submit(annotate_stems, batch, annotations_path, lab) for batch in batches]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            created_files.extend(future.result())
 
     return created_files
 
@@ -202,7 +329,7 @@ def get_acoustic_stems(folder: Path) -> list:
             ac_guit_stems.append(stem)
     return ac_guit_stems
 
-def processing_tracks(audio_path: Path, target_instrument_name:str, copy_folders=True, stereo=True) -> dict:
+def processing_tracks(audio_path: Path, target_instrument_name:str, copy_folders=True, stereo=True, nb_workers=None) -> dict:
     """
     Returns a dict of the processed tracks
 
@@ -212,6 +339,11 @@ def processing_tracks(audio_path: Path, target_instrument_name:str, copy_folders
     """
     stems_ratio = {}
 
+    # presence ratios of all the annotated stems
+    annotations_path = audio_path.parent.joinpath("annotations")
+    index = update_activation_index(get_activation_files(annotations_path), audio_path.parent.joinpath("activation_index.npz"))
+    ratios = get_presence_ratios(index)
+
     track_folders = [folder for folder in audio_path.iterdir() if folder.is_dir()]
 
     for folder in track_folders:
@@ -222,9 +354,9 @@ def processing_tracks(audio_path: Path, target_instrument_name:str, copy_folders
         track_name = folder.name.split("_Full")[0]
         track_stems_ratios = []
         for stem in ac_guit_stems:
-            activation_path = audio_path.parent.joinpath("annotations", stem.name.split(".wav")[0] + ".lab")
-            ratio = get_instrument_ratio(activation_path)
-            track_stems_ratios.append(ratio)
+            # the Cambridge stems are indexed as tracks of a single stem
+            stem_name = stem.name.split(".wav")[0]
+            track_stems_ratios.append({stem_name: ratios[(stem_name, stem_name)]})
         if len(track_stems_ratios) > 0:
             stems_ratio[track_name] = track_stems_ratios
     
@@ -243,54 +375,47 @@ def processing_tracks(audio_path: Path, target_instrument_name:str, copy_folders
 
                     src_folder = audio_path.joinpath(track + "_Full")
                     dst_folder = stems_folder.joinpath(f"{track}_{i+1}")
-                    copytree(src_folder, dst_folder)
+
+                    # link the stems except the others acoustic stems
+                    other_stems = {f"{target_stem}.wav" for target_stems in stems for target_stem in target_stems if target_stem != stem_name}
+                    link_tree(src_folder, dst_folder, exclude=other_stems)
                     copied_folders.append(dst_folder)
-                    
-                    # delete the others acoustic stems
-                    for target_stems in stems:
-                        for target_stem in target_stems.keys():
-                            f = dst_folder.joinpath(f"{target_stem}.wav")
-                            # if it's the current stem, rename
-                            if target_stem == stem_name:
-                                f.rename(dst_folder.joinpath(f"{target_instrument_name}.wav"))
-                            # else remove
-                            else:
-                                f.unlink()  
-
-        # reducing the duration and harmonizing the number of channels and encoding format    
-        print("\nReducing the duration...")
-        for f in tqdm(copied_folders):
+
+                    # rename the current stem
+                    next(dst_folder.glob(f"**/{stem_name}.wav")).rename(dst_folder.joinpath(f"{target_instrument_name}.wav"))
+
+        # reducing the duration and harmonizing the number of channels and encoding format,
+        # in a single pass by stem
+        print("\nNormalizing the stems...")
+        tasks = []
+        for f in copied_folders:
             _, durations = get_stems_durations(f)
-            min_duration = np.floor(min(durations))
+            frames = int(44100 * np.floor(min(durations)))
             for stem in f.glob("**/*.wav"):
-                sr = get_samplerate(stem)
-                wav, _ = load(stem, sr)
-                sf.write(stem, wav[:int(sr*min_duration)], samplerate=44100)
-        
-        # making stereo files
-        if stereo:
-            print("making stereo files")
-            for f in tqdm(copied_folders):
-                for stem in f.glob("**/*.wav"):
-                    make_stereo(str(stem), str(stem))
-
-            
+                tasks.append((stem, dict(channels=2 if stereo else 1, samplerate=44100, subtype="PCM_16", frames=frames)))
+
+        with ProcessPoolExecutor(nb_workers) as executor:
+            futures = [executor.submit(normalize_stem, stem, **params) for stem, params in tasks]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+
     print(f"\n{len(copied_folders)} folders created")
     return stems_ratio 
 
 def get_stems_durations(folder: Path):
     """
     Returns the number of channels and the durations of the stems in the folder
+
+    Only the headers of the stems are read
     """
-    mono = 0
+    channels = 0
     durations = []
     for stem in folder.glob("**/*.wav"):
-        sr = get_samplerate(stem)
-        wav, _ = load(stem, sr, mono=False)
-        mono += len(wav.shape)
-        durations.append(get_duration(wav, sr))
+        info = get_audio_info(stem)
+        channels += info.channels
+        durations.append(info.duration)
 
-    return mono / len(durations), durations
+    return channels / len(durations), durations
 
 def get_folder_stats(audio_path):
     """
@@ -315,21 +440,8 @@ def make_stereo(file1, output):
     """
     Outputs a stereo wav file from the mono input
     """
-    ifile = wave.open(file1)
-
-    (nchannels, sampwidth, framerate, nframes, comptype, compname) = ifile.getparams()
-    assert comptype == 'NONE'  # Compressed not supported yet
-    array_type = {1:'B', 2: 'h', 4: 'l'}[sampwidth]
-    left_channel = array.array(array_type, ifile.readframes(nframes))[::nchannels]
-    ifile.close()
-
-    stereo = 2 * left_channel
-    stereo[0::2] = stereo[1::2] = left_channel
-
-    ofile = wave.open(output, 'w')
-    ofile.setparams((2, sampwidth, framerate, nframes, comptype, compname))
-    ofile.writeframes(stereo.tobytes())
-    ofile.close()
+    # the input is replaced when it is also the output
+    normalize_stem(Path(file1), None if Path(output) == Path(file1) else Path(output), channels=2)
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the magnitude spectrograms of the stems
+
+The magnitude spectrogram of each stem is computed once with the STFT of Open-Unmix
+(periodic hann window, no centering, n_fft=4096, hop=1024) and stored in a memory-mapped
+.npy file of shape (nb_frames, nb_stems, nb_channels, nb_bins), written chunk by chunk.
+SpectrogramDataset (open-unmix/datasets.py) reads random frame windows and mixes the stems
+in the magnitude domain. The open-unmix training computes the STFT in its model from the
+waveforms, it can't read this cache: it is compared to the waveform datasets by the loader
+benchmark (open-unmix/benchmark.py), a training on it needs a model taking spectrograms as input
+"""
+import json
+from pathlib import Path
+import numpy as np
+import scipy.signal
+import soundfile as sf
+from tqdm import tqdm
+
+# Open-Unmix STFT parameters
+n_fft = 4096
+n_hop = 1024
+
+def get_nb_frames(nb_samples, n_fft=n_fft, n_hop=n_hop):
+    """
+    Returns the number of STFT frames of a signal without centering
+    """
+    return max(0, 1 + (nb_samples - n_fft) // n_hop)
+
+def compute_magnitude(audio, n_fft=n_fft, n_hop=n_hop):
+    """
+    Returns the magnitude spectrogram (nb_frames, nb_channels, nb_bins) of the audio
+
+    audio: array (nb_samples, nb_channels)
+    """
+    window = scipy.signal.get_window("hann", n_fft).astype(np.float32)
+    # (nb_frames, nb_channels, n_fft) views of the signal
+    frames = np.lib.stride_tricks.sliding_window_view(audio, n_fft, axis=0)[::n_hop]
+    return np.abs(np.fft.rfft(frames * window, axis=-1)).astype(np.float32)
+
+def cache_track_features(track_folder: Path, output_path: Path, target_file: str, chunk_frames=512,
+                         n_fft=n_fft, n_hop=n_hop) -> dict:
+    """
+    Computes the magnitude spectrograms of the stems of the track, returns the index entry of the track
+
+    The stems are cut to the shortest one, the target stem is stored first
+    chunk_frames: the number of frames computed at once
+    """
+    stems = sorted(track_folder.glob("*.wav"), key=lambda f: (f.name != target_file, f.name))
+    if not stems or stems[0].name != target_file:
+        raise FileNotFoundError(f"No {target_file} in {track_folder}")
+
+    infos = [sf.info(str(f)) for f in stems]
+    nb_samples = min(info.frames for info in infos)
+    channels = max(info.channels for info in infos)
+    nb_frames = get_nb_frames(nb_samples, n_fft, n_hop)
+
+    features = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.float16,
+                                         shape=(nb_frames, len(stems), channels, n_fft // 2 + 1))
+    for i, stem in enumerate(stems):
+        with sf.SoundFile(str(stem)) as f:
+            for start in range(0, nb_frames, chunk_frames):
+                n = min(chunk_frames, nb_frames - start)
+                # the samples of n frames
+                f.seek(start * n_hop)
+                audio = f.read((n - 1) * n_hop + n_fft, dtype="float32", always_2d=True)
+                features[start:start + n, i] = compute_magnitude(audio, n_fft, n_hop)
+    features.flush()
+    del features
+
+    return {
+        "name": track_folder.name,
+        "file": output_path.name,
+        "frames": nb_frames,
+        "channels": channels,
+        "samplerate": infos[0].samplerate,
+        "stems": [f.name for f in stems],
+        "target": 0,
+    }
+
+def cache_split_features(split_folder: Path, output_folder: Path, target_file: str, n_fft=n_fft, n_hop=n_hop,
+                         track_folders=None) -> Path:
+    """
+    Computes the features of the track folders of the split, returns the path of the index
+
+    track_folders: the track folders of the split, instead of the folders of split_folder
+    """
+    output_folder.mkdir(parents=True, exist_ok=True)
+    tracks = []
+    print(f"Computing the {split_folder.name} split spectrograms...")
+    if track_folders is None:
+        track_folders = [f for f in split_folder.iterdir() if f.is_dir()]
+    for track_folder in tqdm(sorted(track_folders)):
+        output_path = output_folder.joinpath(f"{track_folder.name}.npy")
+        tracks.append(cache_track_features(track_folder, output_path, target_file, n_fft=n_fft, n_hop=n_hop))
+
+    index_path = output_folder.joinpath("index.json")
+    index_path.write_text(json.dumps({
+        "n_fft": n_fft,
+        "n_hop": n_hop,
+        "target_file": target_file,
+        "tracks": tracks,
+    }, indent=2))
+    return index_path
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar index of the activation confidence files
+
+The activation files (MedleyDB _ACTIVATION_CONF.lab, Cambridge .lab or .npz) are
+ingested once in a single .npz store of columns (track, stem, time, confidence),
+the presence ratios of every stem are then computed at once with numpy.
+The store is updated incrementally, only the new or modified files are parsed again
+"""
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+MEDLEYDB_SUFFIX = "_ACTIVATION_CONF"
+
+def read_activation_file(activation_path: Path):
+    """
+    Returns the track name and a dict {stem: (time, confidence)} of the activation file
+
+    MedleyDB files have a time column and a column by stem (S01, S02...),
+    Cambridge files annotate a single stem, the track is named after the stem
+    """
+    if activation_path.suffix == ".npz":
+        with np.load(activation_path) as data:
+            confidence = data["confidence"]
+            time = np.arange(len(confidence)) * data["hop_length"] / data["rate"]
+        return activation_path.stem, {activation_path.stem: (time, confidence)}
+
+    dfx = pd.read_csv(activation_path)
+    track = activation_path.stem
+    if track.endswith(MEDLEYDB_SUFFIX):
+        track = track[:-len(MEDLEYDB_SUFFIX)]
+    time = dfx["time"].values
+    return track, {stem: (time, dfx[stem].values) for stem in dfx.columns if stem != "time"}
+
+def get_activation_files(folder: Path) -> list:
+    """
+    Returns the activation files of the folder, the binary .npz files
+    being preferred to the .lab files of the same stem
+    """
+    npz_files = []
+    for f in folder.glob("*.npz"):
+        with np.load(f) as data:
+            if "confidence" in data.files:
+                npz_files.append(f)
+    npz_stems = {f.stem for f in npz_files}
+    return npz_files + [f for f in folder.glob("*.lab") if f.stem not in npz_stems]
+
+def load_activation_index(index_path: Path) -> dict:
+    """
+    Returns the columns of the index, an empty index if the file does not exist
+    or was written with float32 confidences (rounded, they no longer match the files)
+    """
+    if index_path.exists():
+        with np.load(index_path) as data:
+            if data["confidence"].dtype == np.float64:
+                return {k: data[k] for k in data.files}
+    return {
+        "track": np.zeros(0, np.int32), "stem": np.zeros(0, np.int32),
+        "time": np.zeros(0, np.float32), "confidence": np.zeros(0, np.float64),
+        "track_names": np.zeros(0, str), "stem_names": np.zeros(0, str),
+        "file_names": np.zeros(0, str), "file_mtimes": np.zeros(0, np.int64),
+        "file_sizes": np.zeros(0, np.int64), "file_starts": np.zeros(0, np.int64),
+        "file_ends": np.zeros(0, np.int64),
+    }
+
+def update_activation_index(activation_files: list, index_path: Path) -> dict:
+    """
+    Returns the index of the activation files, updated and saved if files were added,
+    modified or removed since the last update
+
+    activation_files: list of Path to the activation files
+    index_path: the .npz store of the index
+    """
+    index = load_activation_index(index_path)
+
+    # rows of the unchanged files
+    previous = {
+        name: (mtime, size, start, end)
+        for name, mtime, size, start, end in zip(index["file_names"], index["file_mtimes"], index["file_sizes"],
+                                                 index["file_starts"], index["file_ends"])
+    }
+
+    track_names = list(index["track_names"])
+    stem_names = list(index["stem_names"])
+    track_codes = {name: i for i, name in enumerate(track_names)}
+    stem_codes = {name: i for i, name in enumerate(stem_names)}
+
+    stats = {str(f): f.stat() for f in sorted(activation_files)}
+    unchanged = {
+        name for name, stat in stats.items()
+        if name in previous and previous[name][:2] == (stat.st_mtime_ns, stat.st_size)
+    }
+    if len(unchanged) == len(stats) == len(previous):
+        return index
+
+    columns = {"track": [], "stem": [], "time": [], "confidence": []}
+    files = {"file_names": [], "file_mtimes": [], "file_sizes": [], "file_starts": [], "file_ends": []}
+    nb_rows = 0
+
+    for name, stat in stats.items():
+        activation_path = Path(name)
+        if name in unchanged:
+            _, _, start, end = previous[name]
+            for column in columns:
+                columns[column].append(index[column][start:end])
+            n = end - start
+        else:
+            track, stems = read_activation_file(activation_path)
+            n = 0
+            for stem, (time, confidence) in stems.items():
+                track_code = track_codes.setdefault(track, len(track_codes))
+                stem_code = stem_codes.setdefault(stem, len(stem_codes))
+                if track_code == len(track_names):
+                    track_names.append(track)
+                if stem_code == len(stem_names):
+                    stem_names.append(stem)
+                columns["track"].append(np.full(len(time), track_code, np.int32))
+                columns["stem"].append(np.full(len(time), stem_code, np.int32))
+                columns["time"].append(np.asarray(time, np.float32))
+                # float64 like pandas, the threshold comparisons match the per-file computation
+                columns["confidence"].append(np.asarray(confidence, np.float64))
+                n += len(time)
+
+        files["file_names"].append(name)
+        files["file_mtimes"].append(stat.st_mtime_ns)
+        files["file_sizes"].append(stat.st_size)
+        files["file_starts"].append(nb_rows)
+        files["file_ends"].append(nb_rows + n)
+        nb_rows += n
+
+    dtypes = {"track": np.int32, "stem": np.int32, "time": np.float32, "confidence": np.float64}
+    index = {k: np.concatenate(v) if v else np.zeros(0, dtypes[k]) for k, v in columns.items()}
+    index.update({k: np.array(v) for k, v in files.items()})
+    index["track_names"] = np.array(track_names, dtype=str)
+    index["stem_names"] = np.array(stem_names, dtype=str)
+    # written through the file, np.savez would append .npz to a path without the suffix
+    with open(index_path, "wb") as f:
+        np.savez(f, **index)
+    return index
+
+def get_presence_ratios(index: dict, threshold=0.5) -> dict:
+    """
+    Returns a dict {(track, stem): ratio} of the ratio of the frames
+    where the confidence is above the threshold, for every stem of the index
+    """
+    nb_stems = len(index["stem_names"])
+    pairs = index["track"].astype(np.int64) * nb_stems + index["stem"]
+    counts = np.bincount(pairs)
+    active = np.bincount(pairs[index["confidence"] > threshold], minlength=len(counts))
+
+    codes = np.flatnonzero(counts)
+    return {
+        (str(index["track_names"][code // nb_stems]), str(index["stem_names"][code % nb_stems])): active[code] / counts[code]
+        for code in codes
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the activation confidence files")
+    parser.add_argument("index", type=Path, help="the .npz store of the index")
+    parser.add_argument("folders", type=Path, nargs="+", help="folders of the .lab or .npz activation files")
+    args = parser.parse_args()
+
+    activation_files = [f for folder in args.folders for f in get_activation_files(folder)]
+    index = update_activation_index(activation_files, args.index)
+    print(f"{len(index['file_names'])} files, {len(index['track_names'])} tracks, {len(index['confidence'])} rows indexed")
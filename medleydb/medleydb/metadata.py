@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Parsed index of the MedleyDB metadata
+
+The "stems" column of the metadata table holds the dict of the stems of each track as text.
+It is parsed once into a normalized table (track, stem_dir, stem_id, filename, instrument)
+with hash indexes by instrument and by stem_dir, the queries then only touch their result
+"""
+from ast import literal_eval
+from collections import namedtuple
+from functools import lru_cache
+import pandas as pd
+
+Stem = namedtuple("Stem", ["track", "stem_dir", "stem_id", "filename", "instrument"])
+
+class MetadataIndex:
+    """
+    Stems of the metadata table indexed by instrument and by stem_dir
+
+    stems: the "stems" column of the metadata dataframe
+    stem_dirs: the "stem_dir" column, deduced from the stem filenames if None
+    """
+    def __init__(self, stems, stem_dirs=None):
+        self.rows = []
+        self.track_stems = {}
+        self.by_instrument = {}
+        self.by_stem_dir = {}
+
+        if stem_dirs is None:
+            stem_dirs = [None] * len(stems)
+
+        for track_stems, stem_dir in zip(stems, stem_dirs):
+            track_stems = literal_eval(track_stems) if isinstance(track_stems, str) else track_stems
+            rows = []
+            for stem_id, s in track_stems.items():
+                track = s["filename"].split("_STEM")[0]
+                rows.append(Stem(track, stem_dir or f"{track}_STEMS", stem_id, s["filename"], s["instrument"]))
+            if not rows:
+                continue
+
+            stem_dir = rows[0].stem_dir
+            self.track_stems[stem_dir] = track_stems
+            self.by_stem_dir[stem_dir] = rows
+            for row in rows:
+                self.by_instrument.setdefault(row.instrument, []).append(row)
+            self.rows.extend(rows)
+
+    def instruments(self) -> list:
+        """
+        Returns the list of unique instruments
+        """
+        return list(self.by_instrument)
+
+    def instrument_stems(self, instrument_name) -> list:
+        """
+        Returns the stems rows of the instrument
+        """
+        return self.by_instrument.get(instrument_name, [])
+
+    def stem_dir_stems(self, stem_dir) -> dict:
+        """
+        Returns the parsed stems dict {stem_id: stem metadata} of the track folder
+        """
+        return self.track_stems[stem_dir]
+
+    def stem_dir_instruments(self, stem_dir) -> list:
+        """
+        Returns the instrument list of the track folder
+        """
+        return list({row.instrument for row in self.by_stem_dir.get(stem_dir, [])})
+
+@lru_cache(maxsize=8)
+def parse_metadata(stems: tuple, stem_dirs: tuple = None) -> MetadataIndex:
+    """
+    Returns the index of the stems column, parsed once for the same content
+    """
+    return MetadataIndex(stems, stem_dirs)
+
+def get_metadata_index(metadata) -> MetadataIndex:
+    """
+    Returns the cached index of the metadata
+
+    metadata: the metadata dataframe, its "stems" column or a MetadataIndex
+    """
+    if isinstance(metadata, MetadataIndex):
+        return metadata
+    if isinstance(metadata, pd.DataFrame):
+        stem_dirs = tuple(metadata["stem_dir"]) if "stem_dir" in metadata.columns else None
+        return parse_metadata(tuple(metadata["stems"]), stem_dirs)
+    return parse_metadata(tuple(metadata))
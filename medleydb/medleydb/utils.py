@@ -8,20 +8,17 @@ import pandas as pd
 from pathlib import Path
 from librosa import load
 import soundfile as sf
+from medleydb.activations import get_activation_files, get_presence_ratios, update_activation_index
+from medleydb.metadata import get_metadata_index
 
 def get_instruments_list(stems) -> list:
     """
     Returns a list of unique instruments
 
-    stems: a Pandas series containing the "stems" column of the metadata dataframe
+    stems: a Pandas series containing the "stems" column of the metadata dataframe,
+    the metadata dataframe or its MetadataIndex
     """
-    instruments_list = []
-    for stem in stems:
-        stem = eval(stem)
-        for s in stem.values():
-            instruments_list.append(s["instrument"])
-
-    return list(set(instruments_list))
+    return get_metadata_index(stems).instruments()
 
 def get_instruments_dict(instruments_list):
     """
@@ -35,16 +32,11 @@ def get_instrument_stems(stems, instrument_name):
     """
     Returns a list of STEMS containing the instrument
 
-    stems: a Pandas series containing the "stems" column of the metadata dataframe
+    stems: a Pandas series containing the "stems" column of the metadata dataframe,
+    the metadata dataframe or its MetadataIndex
     instrument_name: the name of an instrument
     """
-    instrument_stems = []
-    for stem in stems:
-        stem = eval(stem)
-        for s in stem.values():
-            if s["instrument"] == instrument_name:
-                instrument_stems.append(s["filename"])
-    return instrument_stems
+    return [s.filename for s in get_metadata_index(stems).instrument_stems(instrument_name)]
 
 def get_instrument_tracks(instrument_stems, instrument_name):
     """
@@ -55,20 +47,17 @@ def get_instrument_tracks(instrument_stems, instrument_name):
     """
     return list(sorted(set([s.split("_STEM")[0] for s in instrument_stems])))
 
-def get_track_instruments(track_stems):
+def get_track_instruments(stems, stem_dir):
     """
     Returns the instrument list of a track
 
-    track_stems: dict of stems of the track   
+    stems: a Pandas series containing the "stems" column of the metadata dataframe,
+    the metadata dataframe or its MetadataIndex
+    stem_dir: the stems folder of the track
     """
-    track_stems = eval(track_stems)
-    track_instruments = []
-    for s in track_stems:
-        track_instruments.append(track_stems[s]["instrument"])
-        
-    return list(set(track_instruments))
+    return get_metadata_index(stems).stem_dir_instruments(stem_dir)
 
-def get_instrument_ratio(stems, activation_path, instrument_name):
+def get_instrument_ratio(stems, activation_path, instrument_name, index_path=None, threshold=0.5):
     """
     Returns a dict {track: percentage}
     of the ratio of presence of the instrument in the tracks
@@ -77,18 +66,37 @@ def get_instrument_ratio(stems, activation_path, instrument_name):
     stems: the stems in the metadata dataframe
     activation_path: the activation files path
     instrument_name: the target instrument
+    index_path: the activation index store, updated if the activation files changed,
+    the activation files are parsed at each call without index
+    threshold: the confidence above which the instrument is present
     """
     target_stems = get_instrument_stems(stems, instrument_name)
     target_tracks = get_instrument_tracks(target_stems, instrument_name)
 
+    # stem ids of the target by track
+    target_stem_ids = {}
+    for s in get_metadata_index(stems).instrument_stems(instrument_name):
+        target_stem_ids.setdefault(s.track, []).append(s.stem_id)
+
     track_activations = {}
     mising_activation_files = []
 
+    if index_path is not None:
+        index = update_activation_index(get_activation_files(activation_path), index_path)
+        ratios = get_presence_ratios(index, threshold)
+        for track in target_tracks:
+            stem_id = target_stem_ids[track]
+            if (track, stem_id[0]) not in ratios:
+                mising_activation_files.append(track)
+                continue
+            track_activations[track] = ratios[(track, stem_id[0])]
+        return track_activations, mising_activation_files
+
     for track in target_tracks:
         
         target_activation_path = activation_path.joinpath(track + '_ACTIVATION_CONF.lab')
 
-        stem_id = ['S' + s.split('_')[-1][:2] for s in target_stems if s.split('_STEM')[0] == track]
+        stem_id = target_stem_ids[track]
 
         if not target_activation_path.exists():
             mising_activation_files.append(track)
@@ -98,7 +106,7 @@ def get_instrument_ratio(stems, activation_path, instrument_name):
         df1 = dfx[stem_id].iloc[:,0] 
 
         # percentage of the presence of the instrument in the stem
-        presence_ratio = (df1 > 0.5).value_counts(True)[1]
+        presence_ratio = (df1 > threshold).value_counts(True)[1]
         
         track_activations[track] = presence_ratio
     
@@ -117,18 +125,19 @@ if __name__ == "__main__":
     # metadata table path
     data_path = wd_path.parent.joinpath("data")
     metadata_df = pd.read_csv(data_path.joinpath("metadata.csv"))
+    metadata = get_metadata_index(metadata_df)
 
-    instruments_dict = get_instruments_dict(get_instruments_list(metadata_df["stems"]))
+    instruments_dict = get_instruments_dict(get_instruments_list(metadata))
     print("instrument list:")
     for k, v in instruments_dict.items():
         print(f"{k}: {v}")
 
     print()
     target_instrument = "clean electric guitar"
-    clean_guitar_stems = get_instrument_stems(metadata_df["stems"], target_instrument)
+    clean_guitar_stems = get_instrument_stems(metadata, target_instrument)
     clean_guitar_tracks = get_instrument_tracks(clean_guitar_stems, target_instrument)
 
     print(f"{len(clean_guitar_tracks)} tracks containing {target_instrument} ({len(clean_guitar_tracks)/196:.2%})")
 
-    instruments_0 = get_track_instruments(metadata_df.iloc[0]["stems"])
+    instruments_0 = get_track_instruments(metadata, metadata.rows[0].stem_dir)
     print(instruments_0)
\ No newline at end of file
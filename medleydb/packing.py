@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Export of the split folders to memory-mapped arrays
+
+Each track folder of the split is packed in a single .npy file of shape
+(nb_frames, nb_stems, nb_channels), the stems of a time window being contiguous
+the dataloader reads an excerpt by slicing the memory map, without decoding.
+The split index.json lists the tracks, their stems and the position of the target
+"""
+import json
+from pathlib import Path
+import numpy as np
+import soundfile as sf
+from tqdm import tqdm
+
+# scale of the stored samples to float audio
+DTYPE_SCALES = {"int16": 1 / 32768, "float16": 1.0}
+
+def pack_track(track_folder: Path, output_path: Path, target_file: str, dtype="int16", blocksize=1048576) -> dict:
+    """
+    Packs the stems of the track folder in output_path, returns the index entry of the track
+
+    The stems are cut to the shortest one, mono stems are copied to every channel
+    target_file: the name of the target stem, stored first
+    dtype: int16 (exact for 16 bit PCM) or float16
+    """
+    if dtype not in DTYPE_SCALES:
+        raise ValueError(f"Unsupported dtype {dtype}, use one of {list(DTYPE_SCALES)}")
+
+    stems = sorted(track_folder.glob("*.wav"), key=lambda f: (f.name != target_file, f.name))
+    if not stems or stems[0].name != target_file:
+        raise FileNotFoundError(f"No {target_file} in {track_folder}")
+
+    infos = [sf.info(str(f)) for f in stems]
+    frames = min(info.frames for info in infos)
+    channels = max(info.channels for info in infos)
+    read_dtype = "int16" if dtype == "int16" else "float32"
+
+    packed = np.lib.format.open_memmap(output_path, mode="w+", dtype=dtype, shape=(frames, len(stems), channels))
+    for i, stem in enumerate(stems):
+        with sf.SoundFile(str(stem)) as f:
+            for start in range(0, frames, blocksize):
+                block = f.read(min(blocksize, frames - start), dtype=read_dtype, always_2d=True)
+                packed[start:start + len(block), i] = block
+    packed.flush()
+    del packed
+
+    return {
+        "name": track_folder.name,
+        "file": output_path.name,
+        "frames": frames,
+        "channels": channels,
+        "samplerate": infos[0].samplerate,
+        "stems": [f.name for f in stems],
+        "target": 0,
+    }
+
+def pack_split(split_folder: Path, output_folder: Path, target_file: str, dtype="int16", track_folders=None) -> Path:
+    """
+    Packs the track folders of the split, returns the path of the index
+
+    split_folder: a folder of track folders (train, valid)
+    output_folder: the folder of the packed tracks and of index.json
+    track_folders: the track folders of the split, read from the split manifest,
+    instead of the folders of split_folder
+    """
+    output_folder.mkdir(parents=True, exist_ok=True)
+    tracks = []
+    print(f"Packing {split_folder.name} split tracks...")
+    if track_folders is None:
+        track_folders = [f for f in split_folder.iterdir() if f.is_dir()]
+    for track_folder in tqdm(sorted(track_folders)):
+        tracks.append(pack_track(track_folder, output_folder.joinpath(f"{track_folder.name}.npy"), target_file, dtype))
+
+    index_path = output_folder.joinpath("index.json")
+    index_path.write_text(json.dumps({
+        "dtype": dtype,
+        "scale": DTYPE_SCALES[dtype],
+        "target_file": target_file,
+        "tracks": tracks,
+    }, indent=2))
+    return index_path
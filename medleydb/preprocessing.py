@@ -7,18 +7,23 @@ Split the songs in train, valid
 In the data folder, create a train and valid folder, then create 1 folder by song in the correct split folder
 """
 from os import environ
-from shutil import copytree
+from shutil import rmtree
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+import json
+from hashlib import blake2b
 from tqdm import tqdm
-import numpy as np
 from random import sample
 import pandas as pd
-from scipy.io import wavfile
-from librosa import load
-import soundfile as sf
 from sklearn.model_selection import train_test_split
 from medleydb.utils import get_instrument_stems, get_instrument_tracks, get_instruments_dict, get_instruments_list, get_instrument_ratio
+from medleydb.metadata import get_metadata_index
 from cambridge.utils import processing_tracks as cambridge_processing
+from audio.utils import sum_stems, normalize_stem
+from packing import pack_split
+from staging import link_tree
+from features import cache_split_features
 
 wd_path = Path.cwd()
 
@@ -40,15 +45,236 @@ activation_path = metadata_path.joinpath("medleydb", "data", "Annotations", "Act
 # limiting the duration of the STEMS (seconds)
 max_duration = 180
 
-def pre_processing(metadata_df, target_instrument_name, copy_folders=True, stereo=True):
+# packing the tracks of the splits in memory-mapped arrays for the packed training (open-unmix/train.py)
+pack_tracks = False
 
-    STEMS = metadata_df["stems"]
+# computing the magnitude spectrograms of the splits once, for the loader benchmark only
+# (open-unmix/benchmark.py), the open-unmix training computes the STFT in its model
+cache_features = False
+
+# creating the train and valid folders, only read by the trackfolder_var training of open-unmix,
+# the split manifest (split.json) is enough for the virtual training (open-unmix/train.py)
+materialize_split = False
+
+def get_manifest_path(track_folder: Path) -> Path:
+    """
+    Returns the path of the checkpoint of the track folder
+    """
+    return umx_data_path.joinpath("manifests", f"{track_folder.name}.json")
+
+def hash_file(file_path: Path, blocksize=1 << 20) -> str:
+    """
+    Returns the hash of the content of the file
+    """
+    digest = blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_file_entries(folder: Path, previous=None, known_hashes=None) -> dict:
+    """
+    Returns a dict {file name: {size, mtime, hash}} of the files of the folder
+
+    previous: the entries of a previous run, the hash of a file is reused
+    if its size and modification time did not change
+    known_hashes: a dict {(device, inode, size, mtime): hash}, the hash of a file
+    linked to an already hashed file is reused
+    """
+    previous = previous or {}
+    known_hashes = known_hashes or {}
+    entries = {}
+    for f in sorted(folder.rglob("*")):
+        if not f.is_file() or f.name.startswith("."):
+            continue
+        name = str(f.relative_to(folder))
+        stat = f.stat()
+        entry = dict(size=stat.st_size, mtime=stat.st_mtime_ns)
+        old = previous.get(name, {})
+        if (old.get("size"), old.get("mtime")) == (entry["size"], entry["mtime"]):
+            entry["hash"] = old["hash"]
+        else:
+            key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            entry["hash"] = known_hashes.get(key) or hash_file(f)
+        entries[name] = entry
+    return entries
+
+def read_manifest(track_folder: Path) -> dict:
+    """
+    Returns the manifest of the track folder, None if it was not processed
+    """
+    manifest_path = get_manifest_path(track_folder)
+    if not track_folder.exists() or not manifest_path.exists():
+        return None
+    return json.loads(manifest_path.read_text())
+
+def get_stale_reason(src_folder: Path, track_folder: Path, params: dict) -> str:
+    """
+    Returns why the track folder must be rebuilt, None if it is up to date
+
+    The track is stale if the parameters changed, if a source or an output
+    was added, removed or modified (compared by hash)
+    """
+    manifest = read_manifest(track_folder)
+    if manifest is None or "outputs" not in manifest:
+        return "new"
+    if manifest.get("params") != params:
+        return "parameters"
+
+    hashes = lambda entries: {name: e["hash"] for name, e in entries.items()}
+    if hashes(get_file_entries(src_folder, manifest["sources"])) != hashes(manifest["sources"]):
+        return "sources"
+    if hashes(get_file_entries(track_folder, manifest["outputs"])) != hashes(manifest["outputs"]):
+        return "outputs"
+    return None
+
+def write_manifest(track_folder: Path, **fields):
+    """
+    Writes the checkpoint of the track folder, marking it as processed
+    """
+    manifest_path = get_manifest_path(track_folder)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    manifest = dict(track=track_folder.name, files=sorted(f.name for f in track_folder.iterdir()), finished=time(), **fields)
+
+    # written under a temporary name so that a crash never leaves a partial checkpoint
+    tmp_path = manifest_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    tmp_path.replace(manifest_path)
+
+def process_track(src_folder: Path, track_path: Path, track_stems: dict, instruments_dict: dict, target_instrument_name: str,
+                  params: dict = None):
+    """
+    Copies the STEMS of the track, renames them using their instrument name
+    and sums the target STEMS if there are more than one
+
+    Runs in a worker process, a stale folder or a folder left by an interrupted run is processed again,
+    the manifest records the hashes of the sources and of the outputs and the parameters
+    Returns the track folder
+    """
+    params = params or dict(target=target_instrument_name, stereo=True)
+    previous = read_manifest(track_path) or {}
+
+    # stale folder or partial folder from a previous run
+    get_manifest_path(track_path).unlink(missing_ok=True)
+    if track_path.exists():
+        rmtree(track_path)
+
+    # link the target STEMS in open-unmix source folder before renaming or fusion,
+    # renaming and deleting the links leave the original STEMS untouched
+    link_tree(src_folder, track_path)
+
+    # instrument counter
+    stem_instruments = {}
+
+    for stem in track_stems.values():
+        instrument = stem["instrument"]
+
+        # instrument counter to avoid same file name: instrument_#.wav
+        if instrument in stem_instruments:
+            stem_instruments[instrument] += 1
+        else:
+            stem_instruments[instrument] = 1
+
+        # it's not the target instrument we remame the file
+        if instrument != target_instrument_name:
+            stem_file = track_path.joinpath(stem["filename"])
+            stem_file.rename(track_path.joinpath(f"{instruments_dict[instrument]}_{stem_instruments[instrument]}.wav"))
+
+    # if there is more than 1 stem for the target instrument
+    if stem_instruments[target_instrument_name] > 1:
+        # target files fusion, summed block by block at their sampling rate
+        target_files = [f for f in track_path.glob(f"{track_path.name.split('_')[0]}*") if f.is_file()] # the files names are like trackname_*
+        sum_stems(target_files, track_path.joinpath(f"{instruments_dict[target_instrument_name]}.wav"))
+
+        # deleting the partial target files
+        for f in target_files:
+            f.unlink()
+    else:
+        # target instrument file rename
+        for f in track_path.glob(f"{track_path.name.split('_')[0]}*"): # the file name is like trackname_*
+            if f.is_file():
+                f.rename(track_path.joinpath(f"{instruments_dict[target_instrument_name]}.wav"))
+
+    if not params["stereo"]:
+        make_mono(track_path)
+
+    # the outputs linked to the sources are not hashed again
+    sources = get_file_entries(src_folder, previous.get("sources"))
+    known_hashes = {}
+    for name, entry in sources.items():
+        stat = src_folder.joinpath(name).stat()
+        known_hashes[(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)] = entry["hash"]
+
+    write_manifest(track_path, source=str(src_folder), target=target_instrument_name, params=params,
+                   sources=sources, outputs=get_file_entries(track_path, known_hashes=known_hashes))
+    return track_path
+
+def make_mono(track_path: Path):
+    """
+    Converts the stems of the track folder to mono
+    """
+    for f in list(track_path.glob("*.wav")):
+        normalize_stem(f, channels=1)
+    return track_path
+
+def get_build_plan(src_folders: list, track_folders: list, params: dict) -> dict:
+    """
+    Returns the plan of the preprocessing: the stale track folders with the reason
+    and the bytes of their sources, and the processed track folders to remove
+    because they are not selected anymore
+    """
+    stale = {}
+    for src_folder, track_path in zip(src_folders, track_folders):
+        reason = get_stale_reason(src_folder, track_path, params)
+        if reason is not None:
+            nb_bytes = sum(f.stat().st_size for f in src_folder.rglob("*") if f.is_file())
+            stale[track_path] = dict(source=src_folder, reason=reason, bytes=nb_bytes)
+
+    # the MedleyDB tracks processed by a previous run, the other folders have no manifest
+    removed = {}
+    selected = {f.name for f in track_folders}
+    for manifest_path in sorted(umx_data_path.joinpath("manifests").glob("*.json")):
+        track_path = umx_data_path.joinpath("stems", manifest_path.stem)
+        if manifest_path.stem not in selected and track_path.exists():
+            removed[track_path] = sum(f.stat().st_size for f in track_path.rglob("*") if f.is_file())
+
+    return dict(stale=stale, removed=removed)
+
+def print_build_plan(plan: dict, nb_tracks: int):
+    """
+    Prints the tracks to rebuild and to remove
+    """
+    for track_path, task in plan["stale"].items():
+        print(f"rebuild {track_path.name} ({task['reason']}, {task['bytes'] / 1e6:.1f} MB)")
+    for track_path, nb_bytes in plan["removed"].items():
+        print(f"remove {track_path.name} ({nb_bytes / 1e6:.1f} MB)")
+
+    nb_bytes = sum(task["bytes"] for task in plan["stale"].values())
+    print(f"{len(plan['stale'])} tracks to rebuild ({nb_bytes / 1e6:.1f} MB of sources), "
+          f"{nb_tracks - len(plan['stale'])} up to date, {len(plan['removed'])} to remove")
+
+def pre_processing(metadata_df, target_instrument_name, copy_folders=True, stereo=True, nb_workers=None,
+                   threshold=0.6, dry_run=False):
+    """
+    Returns the folders of the tracks containing the target
+
+    The tracks are processed in parallel by nb_workers processes (number of cores by default).
+    Like a build system, only the stale tracks are processed: new tracks, changed parameters,
+    sources or outputs modified since the last run (see get_stale_reason).
+    The tracks not selected anymore are removed
+
+    threshold: the ratio of presence of the target above which a track is selected
+    dry_run: prints what would be rebuilt and removed, nothing is processed
+    """
+    # stems parsed once, indexed by instrument and by stem_dir
+    metadata = get_metadata_index(metadata_df)
 
     # target instrument presence ratio in the target instrument tracks
-    target_track_activations, _ = get_instrument_ratio(metadata_df["stems"], activation_path, target_instrument_name)
+    target_track_activations, _ = get_instrument_ratio(metadata, activation_path, target_instrument_name,
+                                                       index_path=data_path.joinpath("activation_index.npz"))
 
-    # listing the track with a ratio more than 60%
-    instrument_tracks = [track for track, ratio in target_track_activations.items() if ratio > 0.6]
+    # listing the track with a ratio more than the threshold
+    instrument_tracks = [track for track, ratio in target_track_activations.items() if ratio > threshold]
 
     print(f"Pre-processing of the audio files, the target instrument is {target_instrument_name}.")
     print(f"{len(instrument_tracks)} tracks containing the target.")
@@ -58,88 +284,65 @@ def pre_processing(metadata_df, target_instrument_name, copy_folders=True, stere
 
     # the folder where to copy the STEMS for the preprocessing
     umx_stems_folders = [umx_data_path.joinpath("stems", f.name) for f in instrument_folders]
-    
+
     # if the copy is needed
     if copy_folders:
-        # copy the target STEMS in open-unmix source folder before renaming or fusion
-        print("Copying the stems folders...")
-        for i in tqdm(range(len(instrument_folders))):
-            copytree(instrument_folders[i], umx_stems_folders[i])
+        # the parameters changing the outputs of the tracks
+        params = dict(target=target_instrument_name, stereo=stereo)
+        plan = get_build_plan(instrument_folders, umx_stems_folders, params)
+        print_build_plan(plan, len(umx_stems_folders))
+        if dry_run:
+            return umx_stems_folders
+
+        for track_path in plan["removed"]:
+            rmtree(track_path)
+            get_manifest_path(track_path).unlink()
 
         # renaming the STEMS except the target using the instrument dict
-        instruments_dict = get_instruments_dict(get_instruments_list(STEMS))
+        instruments_dict = get_instruments_dict(get_instruments_list(metadata))
 
-        # for each track we rename the STEMS using their instrument name
+        # for each track we copy the STEMS and rename them using their instrument name
         # if the target instrument is in more than 1 stem, we sum the corresponding wav files
-        print("Renaming the files using the instrument name")
-        for track_path in tqdm(umx_stems_folders):
+        tasks = []
+        for track_path, task in plan["stale"].items():
             # the stems of the current track
-            track_stems = metadata_df.query(f"stem_dir == '{track_path.name}'")["stems"].iloc[0]
-            track_stems = eval(track_stems)
-
-            # instrument counter
-            stem_instruments = {}
-
-            for stem in track_stems.values():
-                instrument = stem["instrument"]
-
-                # instrument counter to avoid same file name: instrument_#.wav
-                if instrument in stem_instruments:
-                    stem_instruments[instrument] += 1
-                else:
-                    stem_instruments[instrument] = 1
-
-                # it's not the target instrument we remame the file
-                if instrument != target_instrument_name:
-                    stem_file = track_path.joinpath(stem["filename"])
-                    stem_file.rename(track_path.joinpath(f"{instruments_dict[instrument]}_{stem_instruments[instrument]}.wav"))
-
-            # if there is more than 1 stem for the target instrument
-            if stem_instruments[target_instrument_name] > 1:
-                # target files fusion
-                rate = 44100 # default sampling rate
-                files = []
-                target_file = np.empty
-                for f in track_path.glob(f"{track_path.name.split('_')[0]}*"): # the files names are like trackname_*
-                    if f.is_file():
-                        wav, _ = load(f, sr=rate)
-                        files.append(wav)
-                    # deleting the partial target file 
-                    f.unlink()
-
-                # summing the wav files
-                target_file = sum(files)
-
-                # writing the fusionned target wav file
-                sf.write(track_path.joinpath(f"{instruments_dict[target_instrument_name]}.wav"), data=target_file, samplerate=rate)
-            else:
-                # target instrument file rename
-                for f in track_path.glob(f"{track_path.name.split('_')[0]}*"): # the file name is like trackname_*
-                    if f.is_file():
-                        f.rename(track_path.joinpath(f"{instruments_dict[target_instrument_name]}.wav"))
-
-    if not stereo:
-        # making mono files
-        print("making mono audio...")
-        for f in tqdm(umx_data_path.joinpath("stems").glob("**/*.wav")):
-            wav, sr = load(f, sr=None)
-            sf.write(f, wav, sr)
-    
+            track_stems = metadata.stem_dir_stems(track_path.name)
+            tasks.append((task["source"], track_path, track_stems, instruments_dict, target_instrument_name, params))
+
+        print(f"Copying and renaming the stems of {len(tasks)} tracks...")
+        with ProcessPoolExecutor(nb_workers) as executor:
+            futures = [executor.submit(process_track, *task) for task in tasks]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+
     return umx_stems_folders
 
 def copy_split(split, folders):
     """
-    Create the split folders and copy the files
+    Create the split folders and link the files, copied only if they cannot be linked
     """
     umx_data_path.joinpath(split).mkdir()
-    print(f"Copying {split} split files...")
+    print(f"Staging {split} split files...")
+    stats = {}
     for folder in tqdm(folders):
         umx_data_path.joinpath(split, folder.name).mkdir()
-        copytree(folder, umx_data_path.joinpath(split, folder.name), dirs_exist_ok=True)
+        for method, n in link_tree(folder, umx_data_path.joinpath(split, folder.name)).items():
+            stats[method] = stats.get(method, 0) + n
+    print(f"{split}: {stats}")
 
-def train_valid_split(umx_stems_folders, nb_sample=0):
+def write_split_manifest(splits: dict, manifest_path: Path, **fields):
+    """
+    Writes the split manifest {track: split} of the track folders, the virtual datasets
+    of open-unmix read the stems of the split from the stems folder
     """
-    Split the tracks into train and valid folders
+    tracks = {f.name: split for split, folders in splits.items() for f in sorted(folders)}
+    manifest_path.write_text(json.dumps(dict(root=str(umx_data_path.joinpath("stems")), tracks=tracks, **fields), indent=2))
+
+def train_valid_split(umx_stems_folders, nb_sample=0, test_size=0.2, seed=42, materialize=True):
+    """
+    Split the tracks into train and valid, returns a dict {split: track folders}
+
+    The split manifest is always written, the train and valid folders are created only if materialize
     sample: the size of the sample of folders for testing purpose
     """
 
@@ -147,10 +350,14 @@ def train_valid_split(umx_stems_folders, nb_sample=0):
         umx_stems_folders = sample(umx_stems_folders, nb_sample)
 
     print("Spliting in train valid folders...")
-    train, valid = train_test_split(umx_stems_folders, test_size=0.2, random_state=42)
-    copy_split("train", train)
-    copy_split("valid", valid)
+    train, valid = train_test_split(umx_stems_folders, test_size=test_size, random_state=seed)
+    splits = {"train": train, "valid": valid}
+    write_split_manifest(splits, umx_data_path.joinpath("split.json"), test_size=test_size, seed=seed)
 
+    if materialize:
+        copy_split("train", train)
+        copy_split("valid", valid)
+    return splits
 
 if __name__ == "__main__":
     # MedleyDB metadata
@@ -158,7 +365,7 @@ if __name__ == "__main__":
 
     # target instrument
     instrument_name = "acoustic guitar"
-    target_instrument_name = get_instruments_dict(get_instruments_list(metadata_df["stems"]))[instrument_name]
+    target_instrument_name = get_instruments_dict(get_instruments_list(metadata_df))[instrument_name]
 
     # Cambridge Music Technology add files
     cambridge_audio_path = Path("/media/mvitry/7632099B3209620B/Mickaël/Documents/MIR/Cambridge Music Technology/acoustic guitar")
@@ -169,5 +376,18 @@ if __name__ == "__main__":
 
     umx_stems_folders = [f for f in umx_data_path.joinpath("stems").iterdir()]
 
-    # divide the dataset and create the folder architecture for the training
-    train_valid_split(umx_stems_folders)
\ No newline at end of file
+    # divide the dataset, the folder architecture for the training is created if materialize_split,
+    # the split manifest is enough for the virtual datasets
+    splits = train_valid_split(umx_stems_folders, materialize=materialize_split)
+
+    # optional packing of the tracks of each split in memory-mapped arrays for the training
+    if pack_tracks:
+        for split in ["train", "valid"]:
+            pack_split(umx_data_path.joinpath(split), umx_data_path.joinpath("packed", split), f"{target_instrument_name}.wav",
+                       track_folders=splits[split])
+
+    # optional cache of the magnitude spectrograms, read by the loader benchmark
+    if cache_features:
+        for split in ["train", "valid"]:
+            cache_split_features(umx_data_path.joinpath(split), umx_data_path.joinpath("features", split), f"{target_instrument_name}.wav",
+                                 track_folders=splits[split])
\ No newline at end of file
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Staging of the stems folders without duplicating the audio
+
+The folders are built with hardlinks, or reflinks (copy-on-write clones, on the same
+filesystem) when hardlinks are not permitted, and copied only as a last resort. An existing
+destination is never overwritten, it could be a link of the original. A linked file shares its data
+with the original: it must never be written in place, the modified stems are written to a
+temporary file which then replaces the link (see replaced_file), the original is untouched.
+Renaming and deleting a link is safe.
+
+STAGING_MODE: auto (hardlink, reflink, copy), hardlink, reflink or copy
+"""
+from os import environ, link, replace
+import errno
+from contextlib import contextmanager
+from pathlib import Path
+import shutil
+
+staging_mode = environ.get("STAGING_MODE", "auto")
+
+# ioctl request cloning a file on btrfs, xfs...
+FICLONE = 0x40049409
+
+def reflink(src: Path, dst: Path):
+    """
+    Creates a copy-on-write clone of the file, raises OSError if the filesystem does not support it
+    or if src and dst are on different filesystems, FileExistsError if dst exists
+    """
+    import fcntl
+
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            Path(dst).unlink()
+            raise
+
+def link_file(src: Path, dst: Path, mode=None) -> str:
+    """
+    Stages the file at dst, returns the method used: hardlink, reflink or copy,
+    raises FileExistsError if dst exists
+    """
+    if Path(dst).exists():
+        raise FileExistsError(errno.EEXIST, "File exists", str(dst))
+
+    mode = mode or staging_mode
+    methods = {
+        "auto": ["hardlink", "reflink", "copy"],
+        "hardlink": ["hardlink", "copy"],
+        "reflink": ["reflink", "copy"],
+        "copy": ["copy"],
+    }[mode]
+
+    for method in methods:
+        try:
+            if method == "hardlink":
+                link(src, dst)
+            elif method == "reflink":
+                reflink(src, dst)
+            else:
+                shutil.copy2(src, dst)
+            return method
+        except FileExistsError:
+            raise
+        except OSError:
+            if method == "copy":
+                raise
+
+def link_tree(src_folder: Path, dst_folder: Path, exclude=(), mode=None) -> dict:
+    """
+    Stages the files of the folder like copytree, returns the number of files by method
+    and the number of bytes copied
+
+    exclude: the names of the files not staged
+    """
+    stats = {"hardlink": 0, "reflink": 0, "copy": 0, "bytes_copied": 0}
+    for src in sorted(src_folder.rglob("*")):
+        if src.name in exclude or not src.is_file():
+            continue
+        dst = dst_folder.joinpath(src.relative_to(src_folder))
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        method = link_file(src, dst, mode)
+        stats[method] += 1
+        if method == "copy":
+            stats["bytes_copied"] += src.stat().st_size
+    return stats
+
+@contextmanager
+def replaced_file(path: Path):
+    """
+    Yields a temporary path to write the new content of the file,
+    which then replaces the file, breaking its link with the original
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}")
+    try:
+        yield tmp_path
+        replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
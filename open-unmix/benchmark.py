@@ -0,0 +1,230 @@
+"""
+Benchmark of the training data paths
+
+Compares the samples per second of the dataloaders until the model input:
+- wav: decoding of the excerpts from the split folders and STFT of the batches
+- packed: slicing of the memory-mapped tracks and STFT of the batches
+- features: slicing of the cached magnitude spectrograms, no STFT
+- virtual: remixing of the stems of the split manifest and STFT of the batches
+
+For each loader and number of workers, the excerpts per second, the bytes read,
+the time spent in the dataset (decoding) and the utilisation of the workers are measured.
+The results can be written to a json file and compared with a previous run.
+--synthetic generates a dataset of random stems with all the data paths, no data is needed:
+
+    python benchmark.py --synthetic /tmp/umx_bench --nb-tracks 20 --duration 60 --nb-workers 0 2 4 --output run.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import soundfile as sf
+import torch
+from datasets import TrackFolderDataset, PackedTrackDataset, SpectrogramDataset, VirtualSplitDataset
+
+# preprocessing of the packed tracks and of the spectrograms
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath("medleydb")))
+from packing import pack_split
+from features import cache_split_features
+
+# Open-Unmix STFT parameters
+n_fft = 4096
+n_hop = 1024
+
+def magnitude(x, n_fft=n_fft, n_hop=n_hop):
+    """
+    Returns the magnitude spectrograms (nb_frames, nb_samples, nb_channels, nb_bins) of the batch,
+    as computed by the open-unmix model
+    """
+    nb_samples, nb_channels, nb_timesteps = x.shape
+    window = torch.hann_window(n_fft)
+    X = torch.stft(x.reshape(-1, nb_timesteps), n_fft=n_fft, hop_length=n_hop, window=window,
+                   center=False, return_complex=True).abs()
+    return X.reshape(nb_samples, nb_channels, X.shape[-2], X.shape[-1]).permute(3, 0, 1, 2)
+
+def read_io_counters():
+    """
+    Returns the bytes read by the process: through read calls (rchar, the page cache included)
+    and from the storage (read_bytes, the page faults of the memory maps included), zeros if unavailable
+    """
+    try:
+        counters = dict(line.split(": ") for line in Path("/proc/self/io").read_text().splitlines())
+        return int(counters["rchar"]), int(counters["read_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+class ProfiledDataset(torch.utils.data.Dataset):
+    """
+    Wraps a dataset, each sample also returns the time spent in the dataset,
+    the bytes read and the worker which loaded it
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        rchar, read_bytes = read_io_counters()
+        start = perf_counter()
+        x, y = self.dataset[index]
+        duration = perf_counter() - start
+        end_rchar, end_read_bytes = read_io_counters()
+
+        worker = torch.utils.data.get_worker_info()
+        stats = torch.tensor([duration, end_rchar - rchar, end_read_bytes - read_bytes,
+                              -1 if worker is None else worker.id], dtype=torch.float64)
+        return x, y, stats
+
+def benchmark_loader(dataset, batch_size=32, nb_workers=4, nb_batches=20, stft=True) -> dict:
+    """
+    Returns the measures of the dataloader of the dataset: excerpts per second, bytes read,
+    time spent in the dataset by excerpt and utilisation of the workers
+    (the time spent in the dataset divided by the time available to the workers,
+    an estimate as the batches are prefetched before the measure starts)
+
+    stft: computes the magnitude spectrograms of the batches like the model does
+    """
+    loader = torch.utils.data.DataLoader(ProfiledDataset(dataset), batch_size=batch_size, shuffle=True,
+                                         num_workers=nb_workers, drop_last=True,
+                                         persistent_workers=nb_workers > 0)
+    nb_samples = 0
+    stats = []
+    start = None
+    while nb_samples < nb_batches * batch_size:
+        for x, y, batch_stats in loader:
+            # counted before the STFT, the magnitude spectrograms are (nb_frames, nb_samples, ...)
+            batch_samples = x.shape[0]
+            if stft:
+                x, y = magnitude(x), magnitude(y)
+            # the first batch includes the start of the workers
+            if start is None:
+                start = perf_counter()
+                continue
+            nb_samples += batch_samples
+            stats.append(batch_stats)
+            if nb_samples >= nb_batches * batch_size:
+                break
+
+    elapsed = perf_counter() - start
+    stats = torch.cat(stats).numpy()
+    dataset_time = stats[:, 0].sum()
+    return {
+        "samples_per_s": nb_samples / elapsed,
+        "elapsed_s": elapsed,
+        "samples": nb_samples,
+        "rchar_mb_per_s": stats[:, 1].sum() / elapsed / 1e6,
+        "read_mb_per_s": stats[:, 2].sum() / elapsed / 1e6,
+        "bytes_per_sample": stats[:, 1].sum() / nb_samples,
+        "dataset_ms_per_sample": dataset_time / nb_samples * 1e3,
+        "worker_utilisation": dataset_time / (elapsed * max(nb_workers, 1)),
+    }
+
+def make_synthetic_dataset(root: Path, nb_tracks=20, duration=60.0, nb_stems=4, target_file="acoustic_guitar.wav",
+                           samplerate=44100, channels=2, valid_ratio=0.2, seed=42, packed=True, features=False) -> dict:
+    """
+    Writes a dataset of random stems shaped like the trackfolder_var datasets, returns the paths of the data paths
+
+    root/stems: the track folders, root/split.json: the split manifest,
+    root/train and root/valid: the split folders (links of the stems),
+    root/packed and root/features: the packed tracks and the cached spectrograms if packed and features
+    """
+    rng = np.random.default_rng(seed)
+    stems_folder = root.joinpath("stems")
+    nb_valid = max(1, int(nb_tracks * valid_ratio))
+    tracks = {}
+    for i in range(nb_tracks):
+        name = f"track_{i:03d}"
+        split = "valid" if i < nb_valid else "train"
+        tracks[name] = split
+        track_folder = stems_folder.joinpath(name)
+        track_folder.mkdir(parents=True, exist_ok=True)
+        split_folder = root.joinpath(split, name)
+        split_folder.mkdir(parents=True, exist_ok=True)
+        for k in range(nb_stems):
+            stem = track_folder.joinpath(target_file if k == 0 else f"stem_{k}.wav")
+            if not stem.exists():
+                audio = rng.normal(0, 0.1, (int(duration * samplerate), channels)).astype(np.float32)
+                sf.write(str(stem), audio, samplerate, subtype="PCM_16")
+            if not split_folder.joinpath(stem.name).exists():
+                os.link(stem, split_folder.joinpath(stem.name))
+
+    root.joinpath("split.json").write_text(json.dumps(dict(root=str(stems_folder), tracks=tracks), indent=2))
+
+    paths = {"root": root, "split": root.joinpath("split.json")}
+    for name, enabled, build in [("packed", packed, pack_split), ("features", features, cache_split_features)]:
+        if enabled:
+            for split in ["train", "valid"]:
+                if not root.joinpath(name, split, "index.json").exists():
+                    build(root.joinpath(split), root.joinpath(name, split), target_file)
+            paths[name] = root.joinpath(name)
+    return paths
+
+def compare_results(results: list, previous: list):
+    """
+    Prints the change of the excerpts per second compared to a previous run
+    """
+    key = lambda r: (r["loader"], r["nb_workers"], r["batch_size"], r["seq_dur"])
+    previous = {key(r): r for r in previous}
+    for r in results:
+        if key(r) in previous:
+            change = r["samples_per_s"] / previous[key(r)]["samples_per_s"] - 1
+            print(f"{r['loader']} workers={r['nb_workers']} batch={r['batch_size']}: {change:+.1%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Training data paths benchmark")
+    parser.add_argument("--root", type=Path, help="folder of the train/valid split folders")
+    parser.add_argument("--packed", type=Path, help="folder of the packed splits")
+    parser.add_argument("--features", type=Path, help="folder of the cached spectrograms")
+    parser.add_argument("--split", type=Path, help="split manifest of the stems folder")
+    parser.add_argument("--synthetic", type=Path, help="folder where to generate a synthetic dataset with all the data paths")
+    parser.add_argument("--nb-tracks", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60.0, help="duration of the synthetic tracks (seconds)")
+    parser.add_argument("--nb-stems", type=int, default=4)
+    parser.add_argument("--target-file", default="acoustic_guitar.wav")
+    parser.add_argument("--seq-dur", type=float, default=6.0)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[32])
+    parser.add_argument("--nb-workers", type=int, nargs="+", default=[4])
+    parser.add_argument("--nb-batches", type=int, default=20)
+    parser.add_argument("--output", type=Path, help="json file of the results")
+    parser.add_argument("--compare", type=Path, help="json file of the results of a previous run")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        paths = make_synthetic_dataset(args.synthetic, args.nb_tracks, args.duration, args.nb_stems, args.target_file,
+                                       features=True)
+        args.root, args.packed, args.features, args.split = paths["root"], paths["packed"], paths["features"], paths["split"]
+
+    datasets = {}
+    if args.root:
+        datasets["wav"] = (TrackFolderDataset(args.root, "train", args.target_file, args.seq_dur, samples_per_track=64), True)
+    if args.packed:
+        datasets["packed"] = (PackedTrackDataset(args.packed, "train", args.seq_dur, samples_per_track=64), True)
+    if args.features:
+        datasets["features"] = (SpectrogramDataset(args.features, "train", args.seq_dur, samples_per_track=64), False)
+    if args.split:
+        datasets["virtual"] = (VirtualSplitDataset(args.split, "train", args.target_file, args.seq_dur, samples_per_track=64), True)
+
+    results = []
+    for name, (dataset, stft) in datasets.items():
+        for nb_workers in args.nb_workers:
+            for batch_size in args.batch_size:
+                measures = benchmark_loader(dataset, batch_size, nb_workers, args.nb_batches, stft)
+                results.append(dict(loader=name, nb_workers=nb_workers, batch_size=batch_size, seq_dur=args.seq_dur, **measures))
+                print(f"{name} workers={nb_workers} batch={batch_size}: {measures['samples_per_s']:.1f} samples/s, "
+                      f"{measures['rchar_mb_per_s']:.1f} MB/s read, {measures['dataset_ms_per_sample']:.1f} ms/sample in the dataset, "
+                      f"{measures['worker_utilisation']:.0%} worker utilisation")
+
+    if args.output:
+        args.output.write_text(json.dumps({
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "results": results,
+        }, indent=2))
+    if args.compare:
+        compare_results(results, json.loads(args.compare.read_text())["results"])
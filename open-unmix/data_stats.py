@@ -2,10 +2,13 @@
 Compute some statistics on the preprocessed dataset:
 
 """
+import sys
 from pathlib import Path
 import numpy as np
-from scipy.io import wavfile
-import librosa
+
+# audio utilities shared with the preprocessing
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath("medleydb")))
+from audio.utils import get_audio_info
 
 wd_path = Path.cwd()
 
@@ -25,7 +28,7 @@ def split_duration(split):
         if f.is_file():
             if parent != f.parent.name:
                 parent = f.parent.name
-                duration = librosa.get_duration(filename=f)
+                duration = get_audio_info(f).duration
                 durations[parent] = duration
 
     durations_values = [d for d in durations.values()]
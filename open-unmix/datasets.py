@@ -0,0 +1,291 @@
+"""
+Training datasets
+
+TrackFolderDataset reads the split folders like the trackfolder_var datasets of open-unmix.
+PackedTrackDataset reads the tracks packed by medleydb/packing.py: the excerpts are sliced
+from the memory-mapped tracks, no decoding and no copy until the mix is summed and converted
+to a float tensor. Both return (mix, target) tensors of shape (nb_channels, nb_timesteps).
+SpectrogramDataset reads the magnitude spectrograms cached by medleydb/features.py and
+returns (mix, target) magnitudes of shape (nb_frames, nb_channels, nb_bins), it is only read
+by the loader benchmark: the open-unmix training takes waveforms (see train_datasets.py)
+VirtualSplitDataset reads the tracks of a split from the split manifest written by
+medleydb/preprocessing.py and the stems folder, and remixes the stems at load time
+"""
+import json
+import random
+from pathlib import Path
+import numpy as np
+import soundfile as sf
+import torch
+
+class TrackFolderDataset(torch.utils.data.Dataset):
+    """
+    Random excerpts of the track folders of a split, decoded from the wav files
+
+    root: the folder of the split folders
+    target_file: the name of the target stem, the mix is the sum of all the stems
+    """
+    def __init__(self, root, split="train", target_file="acoustic_guitar.wav", seq_duration=6.0,
+                 samples_per_track=1, random_chunks=True):
+        self.root = Path(root).joinpath(split)
+        self.target_file = target_file
+        self.seq_duration = seq_duration
+        self.samples_per_track = samples_per_track
+        self.random_chunks = random_chunks
+        self.tracks = []
+        for track_folder in sorted(f for f in self.root.iterdir() if f.is_dir()):
+            stems = sorted(track_folder.glob("*.wav"))
+            if track_folder.joinpath(target_file) in stems:
+                infos = [sf.info(str(f)) for f in stems]
+                self.tracks.append({
+                    "stems": stems,
+                    "frames": min(info.frames for info in infos),
+                    "samplerate": infos[0].samplerate,
+                })
+
+    def __len__(self):
+        return len(self.tracks) * self.samples_per_track
+
+    def __getitem__(self, index):
+        track = self.tracks[index // self.samples_per_track]
+        length = track["frames"]
+        if self.seq_duration is not None:
+            length = min(int(self.seq_duration * track["samplerate"]), track["frames"])
+        start = random.randint(0, track["frames"] - length) if self.random_chunks else 0
+
+        x, y = None, None
+        for stem in track["stems"]:
+            audio, _ = sf.read(str(stem), start=start, stop=start + length, dtype="float32", always_2d=True)
+            x = audio if x is None else x + audio
+            if stem.name == self.target_file:
+                y = audio
+
+        return torch.from_numpy(x.T.copy()), torch.from_numpy(y.T.copy())
+
+class PackedTrackDataset(torch.utils.data.Dataset):
+    """
+    Random excerpts of the packed tracks of a split
+
+    root: the folder of the packed splits
+    split: train or valid
+    seq_duration: the duration of the excerpts (seconds), None for the whole tracks
+    samples_per_track: the number of excerpts drawn from each track per epoch
+    random_chunks: draws the excerpts at a random position, from the start otherwise
+    """
+    def __init__(self, root, split="train", seq_duration=6.0, samples_per_track=1, random_chunks=True):
+        self.root = Path(root).joinpath(split)
+        self.index = json.loads(self.root.joinpath("index.json").read_text())
+        self.tracks = self.index["tracks"]
+        self.scale = self.index["scale"]
+        self.seq_duration = seq_duration
+        self.samples_per_track = samples_per_track
+        self.random_chunks = random_chunks
+        self.sample_rate = self.tracks[0]["samplerate"] if self.tracks else 44100
+        # memory maps, opened in each dataloader worker
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.tracks) * self.samples_per_track
+
+    def get_track(self, i):
+        """
+        Returns the memory-mapped stems of the track (nb_frames, nb_stems, nb_channels)
+        """
+        if i not in self.arrays:
+            self.arrays[i] = np.load(self.root.joinpath(self.tracks[i]["file"]), mmap_mode="r")
+        return self.arrays[i]
+
+    def get_window(self, i):
+        """
+        Returns the stems of an excerpt of the track, a view of the memory map
+        """
+        track = self.tracks[i]
+        stems = self.get_track(i)
+        if self.seq_duration is None:
+            return stems
+
+        length = min(int(self.seq_duration * track["samplerate"]), track["frames"])
+        start = random.randint(0, track["frames"] - length) if self.random_chunks else 0
+        return stems[start:start + length]
+
+    def __getitem__(self, index):
+        i = index // self.samples_per_track
+        window = self.get_window(i)
+        target = self.tracks[i]["target"]
+
+        # the mix is the sum of all the stems
+        x = window.sum(axis=1, dtype=np.float32) * self.scale
+        y = window[:, target].astype(np.float32) * self.scale
+
+        return torch.from_numpy(x.T.copy()), torch.from_numpy(y.T.copy())
+
+class SpectrogramDataset(torch.utils.data.Dataset):
+    """
+    Random frame windows of the cached magnitude spectrograms of a split
+
+    The mix is the sum of the magnitudes of the stems, an approximation of the
+    magnitude of the mix which avoids any STFT during the training.
+    After batching the tensors are (nb_samples, nb_frames, nb_channels, nb_bins),
+    permute(1, 0, 2, 3) gives the layout of the open-unmix spectrograms
+
+    root: the folder of the cached splits
+    seq_duration: the duration of the windows (seconds), None for the whole tracks
+    mono: averages the channels like the open-unmix mono models
+    """
+    def __init__(self, root, split="train", seq_duration=6.0, samples_per_track=1, random_chunks=True, mono=False):
+        self.root = Path(root).joinpath(split)
+        self.index = json.loads(self.root.joinpath("index.json").read_text())
+        self.tracks = self.index["tracks"]
+        self.n_hop = self.index["n_hop"]
+        self.seq_duration = seq_duration
+        self.samples_per_track = samples_per_track
+        self.random_chunks = random_chunks
+        self.mono = mono
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.tracks) * self.samples_per_track
+
+    def get_track(self, i):
+        """
+        Returns the memory-mapped spectrograms of the track (nb_frames, nb_stems, nb_channels, nb_bins)
+        """
+        if i not in self.arrays:
+            self.arrays[i] = np.load(self.root.joinpath(self.tracks[i]["file"]), mmap_mode="r")
+        return self.arrays[i]
+
+    def __getitem__(self, index):
+        i = index // self.samples_per_track
+        track = self.tracks[i]
+        spectrograms = self.get_track(i)
+
+        if self.seq_duration is not None:
+            nb_frames = min(int(self.seq_duration * track["samplerate"]) // self.n_hop, track["frames"])
+            start = random.randint(0, track["frames"] - nb_frames) if self.random_chunks else 0
+            spectrograms = spectrograms[start:start + nb_frames]
+
+        X = spectrograms.sum(axis=1, dtype=np.float32)
+        Y = spectrograms[:, track["target"]].astype(np.float32)
+        if self.mono:
+            X, Y = X.mean(axis=1, keepdims=True), Y.mean(axis=1, keepdims=True)
+
+        return torch.from_numpy(X), torch.from_numpy(Y)
+
+class VirtualSplitDataset(torch.utils.data.Dataset):
+    """
+    Random remixes of the stems of the tracks of a split, no split folders are needed
+
+    The excerpts are drawn with a random generator seeded by (seed, epoch, index),
+    the remixes are the same whatever the number of dataloader workers,
+    set_epoch changes them at each epoch. The augmentations:
+    - the stems are scaled by random gains drawn in gain_range
+    - the accompaniment stems are dropped with the probability stem_dropout
+    - the accompaniment comes from another track of the split with the probability cross_track
+
+    split_manifest: the split.json written by medleydb/preprocessing.py
+    root: the stems folder, the root of the manifest by default
+    augment: remixes the stems, the excerpts are the original mixes otherwise
+    """
+    def __init__(self, split_manifest, split="train", target_file="acoustic_guitar.wav", seq_duration=6.0,
+                 samples_per_track=1, random_chunks=True, root=None, seed=42, augment=True,
+                 gain_range=(0.25, 1.25), stem_dropout=0.2, cross_track=0.3):
+        manifest = json.loads(Path(split_manifest).read_text())
+        self.root = Path(root or manifest["root"])
+        self.target_file = target_file
+        self.seq_duration = seq_duration
+        self.samples_per_track = samples_per_track
+        self.random_chunks = random_chunks
+        self.seed = seed
+        self.epoch = 0
+        self.augment = augment
+        self.gain_range = gain_range
+        self.stem_dropout = stem_dropout
+        self.cross_track = cross_track
+
+        self.tracks = []
+        for name in sorted(track for track, track_split in manifest["tracks"].items() if track_split == split):
+            stems = sorted(self.root.joinpath(name).glob("*.wav"))
+            if self.root.joinpath(name, target_file) in stems:
+                infos = [sf.info(str(f)) for f in stems]
+                self.tracks.append({
+                    "target": self.root.joinpath(name, target_file),
+                    "stems": [f for f in stems if f.name != target_file],
+                    "frames": min(info.frames for info in infos),
+                    "samplerate": infos[0].samplerate,
+                })
+        self.sample_rate = self.tracks[0]["samplerate"] if self.tracks else 44100
+
+    def __len__(self):
+        return len(self.tracks) * self.samples_per_track
+
+    def set_epoch(self, epoch):
+        """
+        Draws other remixes for the epoch
+        """
+        self.epoch = epoch
+
+    def draw_start(self, rng, track, length):
+        """
+        Returns the first frame of an excerpt of the track
+        """
+        return int(rng.integers(0, max(track["frames"] - length, 0) + 1)) if self.random_chunks else 0
+
+    def read_excerpt(self, rng, track, stems, start, length):
+        """
+        Returns the sum of the stems on the excerpt of the track, zero padded to length
+        """
+        audio = None
+        for stem in stems:
+            x, _ = sf.read(str(stem), start=start, stop=start + length, dtype="float32", always_2d=True)
+            if self.augment:
+                x = x * rng.uniform(*self.gain_range)
+            audio = x if audio is None else audio + x
+        if len(audio) < length:
+            audio = np.pad(audio, ((0, length - len(audio)), (0, 0)))
+        return audio
+
+    def __getitem__(self, index):
+        rng = np.random.default_rng([self.seed, self.epoch, index])
+        track = self.tracks[index // self.samples_per_track]
+        length = track["frames"]
+        if self.seq_duration is not None:
+            length = min(int(self.seq_duration * track["samplerate"]), track["frames"])
+
+        start = self.draw_start(rng, track, length)
+        y = self.read_excerpt(rng, track, [track["target"]], start, length)
+
+        accompaniment_track = track
+        if self.augment and len(self.tracks) > 1 and rng.random() < self.cross_track:
+            accompaniment_track = self.tracks[rng.integers(len(self.tracks))]
+        stems = accompaniment_track["stems"]
+        if self.augment:
+            stems = [stem for stem in stems if rng.random() >= self.stem_dropout]
+
+        # the accompaniment of the same track is read on the excerpt of the target
+        if accompaniment_track is not track:
+            start = self.draw_start(rng, accompaniment_track, length)
+
+        x = y
+        if stems:
+            x = y + self.read_excerpt(rng, accompaniment_track, stems, start, length)
+
+        return torch.from_numpy(x.T.copy()), torch.from_numpy(y.T.copy())
+
+def load_virtual_datasets(split_manifest, target_file="acoustic_guitar.wav", seq_duration=6.0, samples_per_track=1,
+                          seed=42, **augmentations):
+    """
+    Returns the train and valid datasets of the split manifest, the valid tracks are not cut nor remixed
+    """
+    train_dataset = VirtualSplitDataset(split_manifest, "train", target_file, seq_duration, samples_per_track,
+                                        random_chunks=True, seed=seed, **augmentations)
+    valid_dataset = VirtualSplitDataset(split_manifest, "valid", target_file, seq_duration=None, samples_per_track=1,
+                                        random_chunks=False, seed=seed, augment=False)
+    return train_dataset, valid_dataset
+
+def load_packed_datasets(root, seq_duration=6.0, samples_per_track=1):
+    """
+    Returns the train and valid datasets, the valid tracks are not cut
+    """
+    train_dataset = PackedTrackDataset(root, "train", seq_duration, samples_per_track, random_chunks=True)
+    valid_dataset = PackedTrackDataset(root, "valid", seq_duration=None, samples_per_track=1, random_chunks=False)
+    return train_dataset, valid_dataset
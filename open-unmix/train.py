@@ -1,5 +1,8 @@
 """
 script to launch a training session of the model
+
+trackfolder_var trains on the split folders with the open-unmix datasets, virtual on the
+split manifest and packed on the packed splits with the datasets of datasets.py (see train_datasets.py)
 """
 import os
 from pathlib import Path
@@ -12,8 +15,16 @@ umx_data_path = Path("/path/to/preprocessed/data")
 target_instrument = "acoustic_guitar"
 target_file = "acoustic_guitar.wav"
 model = umx_data_path.joinpath("output")
-dataset_type = "trackfolder_var"
-root = umx_data_path.joinpath("data")
+# trackfolder_var (the train and valid folders, see materialize_split in medleydb/preprocessing.py)
+# virtual (the split manifest) or packed (the packed splits, see pack_tracks in medleydb/preprocessing.py)
+dataset_type = "virtual"
+data_path = umx_data_path.joinpath("data")
+roots = {
+    "trackfolder_var": data_path,
+    "virtual": data_path.joinpath("split.json"),
+    "packed": data_path.joinpath("packed"),
+}
+root = roots[dataset_type]
 output = umx_data_path.joinpath("output")
 epochs = "200"
 batch_size = "32"
@@ -23,11 +34,15 @@ nb_workers = "4"
 ext = ".wav"
 seed = "42"
 
-args = [
-    "python", "train.py",
+# the datasets of this folder are given to the training of open-unmix by train_datasets.py
+if dataset_type == "trackfolder_var":
+    command = ["python", "train.py", "--dataset", dataset_type]
+else:
+    command = ["python", str(Path(__file__).resolve().parent.joinpath("train_datasets.py")), "--data", dataset_type]
+
+args = command + [
     "--target", target_instrument,
     #"--model", str(model), # uncomment to resume training
-    "--dataset", dataset_type,
     "--root", str(root),
     "--output", str(output),
     "--epochs", epochs,
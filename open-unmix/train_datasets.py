@@ -0,0 +1,58 @@
+"""
+Training of the open-unmix model on the datasets of datasets.py
+
+Runs the training of the open-unmix repository (the current directory, see train.py)
+with its data.load_datasets replaced:
+- --data virtual: --root is the split manifest (split.json) written by medleydb/preprocessing.py,
+the stems of the tracks are remixed at load time, other remixes at each epoch
+- --data packed: --root is the folder of the splits packed by medleydb/packing.py
+
+The other arguments are the ones of the open-unmix training
+"""
+import argparse
+import os
+import sys
+
+# the modules of the open-unmix repository first, its train.py and not the launcher of this folder
+sys.path.insert(0, os.getcwd())
+import data
+import train
+from datasets import load_packed_datasets, load_virtual_datasets
+
+def get_load_datasets(data_type):
+    """
+    Returns the load_datasets(parser, args) of the open-unmix data module for the data type
+    """
+    def load_datasets(parser, args):
+        parser.add_argument("--target-file", type=str, default="acoustic_guitar.wav")
+        parser.add_argument("--ext", type=str, default=".wav")
+        parser.add_argument("--samples-per-track", type=int, default=64)
+        args = parser.parse_args()
+
+        if data_type == "packed":
+            train_dataset, valid_dataset = load_packed_datasets(args.root, args.seq_dur, args.samples_per_track)
+        else:
+            train_dataset, valid_dataset = load_virtual_datasets(args.root, args.target_file, args.seq_dur,
+                                                                 args.samples_per_track, seed=args.seed)
+        return train_dataset, valid_dataset, args
+    return load_datasets
+
+def with_epochs(train_epoch):
+    """
+    Returns the training of an epoch, the datasets with a set_epoch draw the samples of the next epoch first
+    """
+    def run(args, unmix, device, train_sampler, optimizer):
+        dataset = train_sampler.dataset
+        if hasattr(dataset, "set_epoch"):
+            dataset.set_epoch(dataset.epoch + 1)
+        return train_epoch(args, unmix, device, train_sampler, optimizer)
+    return run
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--data", choices=["virtual", "packed"], required=True)
+    args, sys.argv[1:] = parser.parse_known_args()
+
+    data.load_datasets = get_load_datasets(args.data)
+    train.train = with_epochs(train.train)
+    train.main()
@@ -1,47 +1,142 @@
+import logging
+import sys
 from os import environ
+from time import perf_counter
 from pathlib import Path
-from flask import Flask, flash, render_template, request, redirect, url_for, send_from_directory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import Flask, Response, abort, flash, g, render_template, request, redirect, url_for, send_from_directory
 from werkzeug.utils import secure_filename
-from librosa import get_duration, get_samplerate
-from scipy.io import wavfile
-from test import separate
+from separation import separate_file
+from jobs import JobQueue, QueueFull
+from registry import preload
+from engine import configure_threads, init_worker, settings as engine_settings
+from cache import KEY_PATTERN, ResultCache
+from storage import StorageManager
+from metrics import Trace, metrics, record_trace
+import ingest
+from ingest import IngestRequest, allowed_file, check_header, store_mix, MIMETYPES
+from previews import VARIANTS, get_variant, is_variant
 
-ALLOWED_EXTENSIONS = {'wav'}
+# audio utilities shared with the preprocessing
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath("medleydb")))
+from audio.utils import get_audio_info
 
-model_name = "/path/to/model"
-target_instrument = "acoustic_guitar"
+model_name = environ.get('MODEL_NAME', "/path/to/model")
+# the targets separated in one pass, e.g. acoustic_guitar,clean_electric_guitar
+target_instruments = environ.get('TARGET_INSTRUMENTS', "acoustic_guitar").split(",")
+device = environ.get('DEVICE', 'cpu')
 
+# separation workers: threads of this process sharing the models and batching their windows (thread),
+# or worker processes sharing the cores (process)
+executor_type = environ.get('EXECUTOR', 'thread')
+
+# streaming separation windows (seconds), 0 to separate the whole mix at once
+window_duration = int(environ.get('WINDOW_DURATION', 30))
+overlap_duration = 2
+
+
+# the model loads, the threads of the workers and the traces are logged at INFO
+logging.basicConfig(level=environ.get('LOG_LEVEL', 'INFO'),
+                    format="%(asctime)s %(process)d %(name)s %(levelname)s %(message)s")
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = environ['UPLOAD_FOLDER']
 app.config['SECRET_KEY'] = environ['SECRET_KEY']
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# the uploads are received in memory and refused as soon as they are too large or too long
+app.request_class = IngestRequest
+app.config['MAX_CONTENT_LENGTH'] = int(environ.get('MAX_UPLOAD_BYTES', 200 * 1024**2))
+ingest.max_duration = float(environ.get('MAX_UPLOAD_DURATION', 600))
+
+# format of the stored mixes and results, flac or wav
+output_format = environ.get('OUTPUT_FORMAT', 'flac')
+
+# browser cache of the results (seconds), their names are the hash of their content
+results_max_age = int(environ.get('RESULTS_MAX_AGE', 24 * 3600))
+
+# models kept in memory by each worker, loaded when the worker starts if PRELOAD_MODELS is set
+max_models = int(environ.get('MAX_MODELS', max(2, len(target_instruments))))
+preload_targets = target_instruments if environ.get('PRELOAD_MODELS') else []
+
+# separation workers, the uploads are refused when max_depth jobs are pending
+nb_workers = int(environ.get('NB_WORKERS', 2))
+if executor_type == 'thread':
+    engine_settings["max_batch_size"] = int(environ.get('MAX_BATCH_SIZE', nb_workers))
+    engine_settings["max_wait"] = float(environ.get('MAX_BATCH_WAIT', 0.02))
+    engine_settings["max_padding"] = float(environ.get('MAX_BATCH_PADDING', 0.25))
+    configure_threads(nb_workers=1)
+    preload(model_name, preload_targets, device, max_models)
+    executor = ThreadPoolExecutor(nb_workers)
+else:
+    executor = ProcessPoolExecutor(nb_workers, initializer=init_worker,
+        initargs=(nb_workers, model_name, preload_targets, device, max_models))
 
-def get_separate_wav(mix_wav, target_instrument, model_name):
+def record_job(job_id, status):
     """
-    Returns the separation of the mix
+    Records the metrics of a finished job, and the stages and the models registry of its worker
     """
-    estimates = separate(audio=mix_wav,
-        targets=[target_instrument],
-        model_name=model_name,
-        device="cuda")
+    metrics.inc("separation_jobs_total", state=status["state"])
+    metrics.observe("separation_job_wait_seconds", status.get("started", status["finished"]) - status["submitted"])
+    if "started" in status:
+        metrics.observe("separation_job_run_seconds", status["finished"] - status["started"])
+    # the results of the entry are complete, it can be evicted
+    key = status["context"].get("key")
+    if status["state"] == "done":
+        storage.update(key)
+    storage.unpin(key)
+    result = status.get("result")
+    if result:
+        record_trace(result["stages"], "job", job_id=job_id, key=status["context"].get("key"))
+        registry_stats = result["registry"]
+        for name in ("hits", "misses", "hit_rate"):
+            metrics.set(f"model_registry_{name}", registry_stats[name], pid=result["pid"])
+        # the keys are model/target/device, the model name is a path
+        for key, load_time in registry_stats["load_times"].items():
+            _, target, _ = key.rsplit("/", 2)
+            metrics.set("model_registry_load_seconds", load_time, target=target, pid=result["pid"])
 
-    pred_wav = estimates[target_instrument].squeeze().astype("int16")
-    comp_wav = estimates["accompaniment"].squeeze().astype("int16")
+jobs = JobQueue(separate_file,
+    nb_workers=nb_workers,
+    max_depth=int(environ.get('MAX_QUEUE_DEPTH', 16)),
+    executor=executor,
+    on_done=record_job)
+
+# separation results, keyed by the hash of the decoded mix, one folder by entry
+# the entries not accessed for CACHE_MAX_AGE seconds or over CACHE_MAX_BYTES are deleted in the background
+storage = StorageManager(app.config['UPLOAD_FOLDER'],
+    max_bytes=int(environ.get('CACHE_MAX_BYTES', 5 * 1024**3)),
+    max_age=int(environ.get('CACHE_MAX_AGE', 7 * 24 * 3600)),
+    interval=int(environ.get('CACHE_EVICTION_INTERVAL', 300)))
+storage.start()
+cache = ResultCache(storage, extension=output_format)
+
+# jobs of the results being separated {cache key: job id}
+pending_jobs = {}
+
+@app.before_request
+def start_timer():
+    g.start = perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or "unknown"
+    metrics.inc("http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.observe("http_request_duration_seconds", perf_counter() - g.start, endpoint=endpoint)
+    return response
 
-    return pred_wav, comp_wav
-  
 @app.route("/", methods=['GET', 'POST'])
 def index():
     if request.method == "POST":
+        # the upload is decoded while it is received
+        trace = Trace()
+        with trace.stage("receive"):
+            files = request.files
+
         # check if the post request has the file part
-        if 'mix' not in request.files:
+        if 'mix' not in files:
             flash('No file part')
             return redirect(request.url)
-        file = request.files['mix']
+        file = files['mix']
 
         # if user does not select file, browser also
         # submit an empty part without filename
@@ -51,31 +146,137 @@ def index():
 
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            mix_path = Path(app.config['UPLOAD_FOLDER'], filename)
-            mix_name = filename.split(".wav")[0] 
-            file.save(mix_path)
+            buffer = file.stream.getvalue()
+            nb_bytes = len(buffer)
+            trace.add_bytes("receive", nb_bytes)
+
+            # whole file header, the duration of the short files and of the OGG files is checked here
+            with trace.stage("probe"):
+                check_header(buffer, final=True)
+                info = get_audio_info(file.stream)
+            metadata = f"{info.duration}s - {info.samplerate}Hz"
+
+            # the results are stored under the hash of the audio, the model and the target
+            with trace.stage("hash", nb_bytes):
+                file.stream.seek(0)
+                key = cache.key(file.stream, model_name, target_instruments)
+            mix_path, output_paths = cache.paths(key, target_instruments)
 
-            duration = get_duration(filename=mix_path)
-            sr =  get_samplerate(mix_path)
-            metadata = f"{duration}s - {sr}Hz"
+            # the entry can't be evicted from the storage of the mix until its results are complete,
+            # the pin is released by record_job once submitted, here otherwise
+            storage.pin(key)
+            submitted = False
+            try:
+                # the decoded mix is stored in the output format for the workers and the player
+                if not mix_path.exists():
+                    storage.create(key)
+                    with trace.stage("store"):
+                        store_mix(file.stream, mix_path)
+                    trace.add_bytes("store", mix_path.stat().st_size)
+                    storage.update(key)
+                results = dict(filename=filename, metadata=metadata, mix=mix_path.name)
 
-            # mix separation
-            sr, mix_wav = wavfile.read(mix_path)
-            pred_wav, comp_wav = get_separate_wav(mix_wav, target_instrument, model_name)
+                hit = cache.get(key, target_instruments) is not None
+                metrics.inc("result_cache_requests_total", result="hit" if hit else "miss")
+                metrics.observe("upload_audio_seconds", info.duration)
+                record_trace(trace.as_dict(), "upload", key=key, filename=filename, duration=info.duration)
+                if hit:
+                    return redirect(url_for('separation', **results))
 
-            pred_path = Path(app.config['UPLOAD_FOLDER'], "{}_{}.wav".format(mix_name, target_instrument))
-            comp_path = Path(app.config['UPLOAD_FOLDER'], "{}_comp.wav".format(mix_name))
+                # the same mix is already being separated, its job holds its own pin
+                job_id = pending_jobs.get(key)
+                if job_id is not None and jobs.status(job_id) is not None \
+                        and jobs.status(job_id)["state"] in ("queued", "running"):
+                    return redirect(url_for('job', job_id=job_id))
 
-            wavfile.write(pred_path, sr, pred_wav)
-            wavfile.write(comp_path, sr, comp_wav)
+                # mix separation by the workers, written window by window when streaming
+                payload = dict(mix_path=mix_path, output_paths=output_paths,
+                    targets=target_instruments, model_name=model_name, device=device,
+                    window_duration=window_duration, overlap_duration=overlap_duration)
+                try:
+                    job_id = jobs.submit(payload, context=dict(key=key, results=results))
+                except QueueFull:
+                    metrics.inc("separation_jobs_rejected_total")
+                    flash('Too many separations in progress, please retry in a few minutes')
+                    return render_template("index.html"), 429
+                submitted = True
+            finally:
+                if not submitted:
+                    storage.unpin(key)
 
-            return redirect(url_for('separation', filename=filename, metadata=metadata, pred=pred_path.name, comp=comp_path.name))
+            pending_jobs[key] = job_id
+
+            return redirect(url_for('job', job_id=job_id))
     
     return render_template("index.html")
 
-@app.route("/separation/<filename>/<metadata>/<pred>/<comp>")
-def separation(filename, metadata, pred, comp):
-    return render_template("results.html", filename=filename, metadata=metadata, pred=pred, comp=comp)
+@app.route("/jobs/<job_id>")
+def job(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        abort(404)
+
+    if status["state"] in ("done", "failed"):
+        pending_jobs.pop(status["context"]["key"], None)
+
+    if status["state"] == "done":
+        return redirect(url_for('separation', **status["context"]["results"]))
+
+    if status["state"] == "failed":
+        flash('The separation failed: {}'.format(status["error"]))
+        return redirect(url_for('index'))
+
+    return render_template("job.html", job_id=job_id, status=status)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    metrics.set("separation_queue_depth", jobs.backend.depth())
+    for name, value in cache.stats().items():
+        metrics.set(f"result_cache_{name}", value)
+    for name, value in storage.usage().items():
+        metrics.set(f"result_storage_{name}", value)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/results/<name>")
+def results(name):
+    """
+    Serves a mix or a result, ?variant=preview for its compressed preview encoded on first request
+
+    The files are content-addressed, they are cached by the browsers and served by ranges
+    so that the players only fetch what they play
+    """
+    path = storage.path(name)
+    if path is None or not path.is_file():
+        abort(404)
+    # playing or downloading a result keeps its entry from the age eviction
+    storage.touch(path.parent.name)
+
+    variant = request.args.get("variant")
+    if variant is not None:
+        # no variant of a variant, e.g. a.preview.preview.ogg
+        if variant not in VARIANTS or is_variant(path):
+            abort(404)
+        variant_path, encoded = get_variant(path, variant)
+        if encoded:
+            metrics.inc("result_variants_encoded_total", variant=variant)
+            storage.update(path.parent.name)
+        name = variant_path.name
+
+    response = send_from_directory(path.parent, name, conditional=True, max_age=results_max_age)
+    metrics.inc("result_bytes_served_total", response.content_length or 0, variant=variant or "original")
+    return response
+
+@app.route("/separation/<filename>/<metadata>/<mix>")
+def separation(filename, metadata, mix):
+    match = KEY_PATTERN.match(mix)
+    if match is None:
+        abort(404)
+    storage.touch(match.group(1))
+    _, output_paths = cache.paths(match.group(1), target_instruments)
+    sources = [(name.replace("_", " ").capitalize(), path.name) for name, path in output_paths.items()]
+    mimetype = MIMETYPES.get(Path(mix).suffix[1:], "audio/wav")
+    return render_template("results.html", filename=filename, metadata=metadata, mix=mix, sources=sources,
+                           mimetype=mimetype, preview_mimetype=VARIANTS["preview"]["mimetype"])
 
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,242 @@
+"""
+Latency and throughput benchmark of the separation
+
+The mixes are synthetic (noise and harmonics) and the models have random weights,
+the benchmark runs on a CPU without trained models. For each mix duration, number
+of channels and number of concurrent separations, the p50/p95 latencies, the real-time
+factor (separation time / mix duration), the throughput and the peak RSS are measured.
+--nb-targets separates several targets in one pass, sharing the STFT of the mix.
+--padding measures how the estimates of a window change when it is padded with zero frames
+to be batched with a longer window: the SDR of the padded estimate, the estimate of the
+window alone being the reference (--model to measure it with trained models).
+
+    python benchmark.py --durations 10 60 600 --channels 1 2 --concurrency 1 2 4 --output run.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import soundfile as sf
+import torch
+from model import OpenUnmix
+from utils import bandwidth_to_max_bin
+from registry import registry
+from engine import configure_threads, settings as engine_settings
+import separation
+from separation import separate_file
+
+target_instrument = "acoustic_guitar"
+
+def get_targets(nb_targets):
+    """
+    Returns the names of the benchmarked targets, the first one is target_instrument
+    """
+    return [target_instrument] + [f"target_{k}" for k in range(1, nb_targets)]
+
+def make_random_model(nb_channels=2, n_fft=4096, n_hop=1024, hidden_size=512, bandwidth=16000, rate=44100):
+    """
+    Returns an Open-Unmix model with random weights, configured like the trained models
+    """
+    unmix = OpenUnmix(n_fft=n_fft, n_hop=n_hop, nb_channels=nb_channels, hidden_size=hidden_size,
+                      max_bin=bandwidth_to_max_bin(rate, n_fft, bandwidth))
+    unmix.stft.center = True
+    unmix.eval()
+    return unmix
+
+def register_random_models(channels, device="cpu", hidden_size=512, seed=42, targets=(target_instrument,)) -> dict:
+    """
+    Registers a random model by number of channels and target, returns the model names {channels: name}
+    """
+    torch.manual_seed(seed)
+    registry.max_models = max(registry.max_models, len(channels) * len(targets))
+    names = {}
+    for nb_channels in channels:
+        names[nb_channels] = f"random-{nb_channels}ch-{hidden_size}"
+        for target in targets:
+            registry.put(names[nb_channels], target, make_random_model(nb_channels, hidden_size=hidden_size).to(device), device)
+    return names
+
+def make_mix(path: Path, duration, channels=2, rate=44100, seed=42):
+    """
+    Writes a mix of noise and harmonics, written block by block
+    """
+    rng = np.random.default_rng(seed)
+    block = 10 * rate
+    with sf.SoundFile(str(path), "w", samplerate=rate, channels=channels, subtype="PCM_16") as f:
+        for start in range(0, int(duration * rate), block):
+            t = np.arange(start, min(start + block, int(duration * rate)))[:, None] / rate
+            audio = 0.1 * rng.standard_normal((len(t), channels)) + 0.2 * np.sin(2 * np.pi * 220 * t * np.arange(1, channels + 1))
+            f.write(audio)
+
+class PeakMemory:
+    """
+    Samples the resident memory of the process while the context is open, peak in MB
+
+    The peak of the process (ru_maxrss) is used when /proc is unavailable
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.stop = threading.Event()
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def read_rss(self):
+        try:
+            return int(Path("/proc/self/statm").read_text().split()[1]) * self.page_size / 1e6
+        except (OSError, IndexError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+    def sample(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, self.read_rss())
+            self.stop.wait(self.interval)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.read_rss())
+
+def separate_timed(mix_path, output_folder, i, model_name, targets, device, window_duration, overlap_duration):
+    """
+    Returns the latency of the separation of the mix (seconds)
+    """
+    output_paths = {name: output_folder.joinpath(f"{i}_{name}.wav") for name in list(targets) + ["accompaniment"]}
+    start = perf_counter()
+    separate_file(mix_path, output_paths, targets, model_name, device, window_duration, overlap_duration)
+    return perf_counter() - start
+
+def benchmark_separation(mix_path, model_name, duration, concurrency=1, repeats=3, device="cpu",
+                         window_duration=separation.window_duration, overlap_duration=separation.overlap_duration,
+                         targets=(target_instrument,)) -> dict:
+    """
+    Returns the latencies, real-time factor, throughput and peak RSS of repeats x concurrency
+    separations of the mix, concurrency separations running at once
+    """
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp, PeakMemory() as memory:
+        output_folder = Path(tmp)
+        start = perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            futures = [executor.submit(separate_timed, mix_path, output_folder, i, model_name, list(targets), device,
+                                       window_duration, overlap_duration)
+                       for i in range(repeats * concurrency)]
+            latencies = [f.result() for f in futures]
+        elapsed = perf_counter() - start
+
+    return {
+        "p50_s": float(np.percentile(latencies, 50)),
+        "p95_s": float(np.percentile(latencies, 95)),
+        "rtf_p50": float(np.percentile(latencies, 50)) / duration,
+        "separations_per_min": len(latencies) / elapsed * 60,
+        "audio_s_per_s": len(latencies) * duration / elapsed,
+        "peak_rss_mb": memory.peak,
+    }
+
+def padding_sdr(mix_path, model_name, target, padding, device="cpu") -> float:
+    """
+    Returns the SDR (dB) of the magnitude estimate of the mix padded with zero frames, padding being
+    the fraction of the frames of the batch, the estimate of the mix alone being the reference
+    """
+    audio, _ = sf.read(str(mix_path), dtype="float32", always_2d=True)
+    unmix = registry.get(model_name, target, device)
+    view = registry.get_view(model_name, target, device)
+    with torch.no_grad():
+        spectrogram = view.spec(unmix.stft(torch.from_numpy(audio.T[None, ...].copy()).to(device)))
+        nb_frames = len(spectrogram)
+        padded = torch.nn.functional.pad(spectrogram, (0, 0, 0, 0, 0, 0, 0, int(round(nb_frames * padding / (1 - padding)))))
+        # the model shifts its input in place
+        reference = view(spectrogram.clone())
+        estimate = view(padded)[:nb_frames]
+    return float(10 * torch.log10(reference.pow(2).sum() / (reference - estimate).pow(2).sum()))
+
+def compare_results(results: list, previous: list):
+    """
+    Prints the change of the p50 latency and of the throughput compared to a previous run
+    """
+    key = lambda r: (r["duration"], r["channels"], r["concurrency"], r["window_duration"], r["max_batch_size"],
+                     r.get("nb_targets", 1))
+    previous = {key(r): r for r in previous}
+    for r in results:
+        if key(r) in previous:
+            p = previous[key(r)]
+            print(f"{r['duration']}s {r['channels']}ch x{r['concurrency']} {r.get('nb_targets', 1)} targets: p50 {r['p50_s'] / p['p50_s'] - 1:+.1%}, "
+                  f"throughput {r['audio_s_per_s'] / p['audio_s_per_s'] - 1:+.1%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Separation latency and throughput benchmark")
+    parser.add_argument("--durations", type=float, nargs="+", default=[10, 60, 600], help="durations of the mixes (seconds)")
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--nb-targets", type=int, nargs="+", default=[1], help="targets separated in one pass")
+    parser.add_argument("--target-workers", type=int, help="models of the targets running at the same time")
+    parser.add_argument("--repeats", type=int, default=3, help="separations by concurrent client")
+    parser.add_argument("--window-duration", type=float, default=separation.window_duration,
+                        help="streaming windows (seconds), 0 to separate the whole mix at once")
+    parser.add_argument("--overlap-duration", type=float, default=separation.overlap_duration)
+    parser.add_argument("--max-batch-size", type=int, default=1, help="batching of the windows of the concurrent separations")
+    parser.add_argument("--max-padding", type=float, default=engine_settings["max_padding"],
+                        help="fraction of padded frames of the batched windows")
+    parser.add_argument("--padding", type=float, nargs="*", default=[],
+                        help="fractions of padded frames whose SDR is measured, e.g. 0.1 0.25 0.5")
+    parser.add_argument("--model", help="folder of the trained models of --padding, random models otherwise")
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", type=Path, help="json file of the results")
+    parser.add_argument("--compare", type=Path, help="json file of the results of a previous run")
+    args = parser.parse_args()
+
+    engine_settings["max_batch_size"] = args.max_batch_size
+    engine_settings["max_padding"] = args.max_padding
+    configure_threads(nb_workers=1)
+    if args.target_workers:
+        engine_settings["target_workers"] = args.target_workers
+    model_names = register_random_models(args.channels, args.device, args.hidden_size,
+                                         targets=get_targets(max(args.nb_targets)))
+
+    results = []
+    paddings = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for duration in args.durations:
+            for channels in args.channels:
+                mix_path = Path(tmp).joinpath(f"mix_{duration:g}s_{channels}ch.wav")
+                make_mix(mix_path, duration, channels)
+                for padding in args.padding:
+                    sdr = padding_sdr(mix_path, args.model or model_names[channels], target_instrument, padding, args.device)
+                    paddings.append(dict(duration=duration, channels=channels, padding=padding, sdr_db=sdr))
+                    print(f"{duration:g}s {channels}ch padded by {padding:.0%}: SDR {sdr:.1f} dB")
+                for concurrency in args.concurrency:
+                    for nb_targets in args.nb_targets:
+                        measures = benchmark_separation(mix_path, model_names[channels], duration, concurrency, args.repeats,
+                                                        args.device, args.window_duration, args.overlap_duration,
+                                                        get_targets(nb_targets))
+                        results.append(dict(duration=duration, channels=channels, concurrency=concurrency,
+                                            nb_targets=nb_targets, window_duration=args.window_duration,
+                                            max_batch_size=args.max_batch_size, **measures))
+                        print(f"{duration:g}s {channels}ch x{concurrency} {nb_targets} targets: p50 {measures['p50_s']:.2f}s, p95 {measures['p95_s']:.2f}s, "
+                              f"RTF {measures['rtf_p50']:.3f}, {measures['audio_s_per_s']:.1f} audio s/s, "
+                              f"peak RSS {measures['peak_rss_mb']:.0f} MB")
+
+    if args.output:
+        args.output.write_text(json.dumps({
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "hidden_size": args.hidden_size,
+            "max_padding": args.max_padding,
+            "results": results,
+            "padding": paddings,
+        }, indent=2))
+    if args.compare:
+        compare_results(results, json.loads(args.compare.read_text())["results"])
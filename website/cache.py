@@ -0,0 +1,81 @@
+"""
+Content-addressed cache of the separation results
+
+The results are keyed by the hash of the decoded audio, the model and the targets:
+the same mix uploaded again, even under another name or in another container,
+is served without running the separation.
+An entry is the set of files named after the key ({key}.flac, {key}_{target}.flac,
+{key}_comp.flac) in the folder of the entry, the storage manager deletes the least
+recently used entries
+"""
+import hashlib
+import re
+import threading
+import soundfile as sf
+
+# files of the cache entries: {key}.flac, {key}_{target}.flac, {key}_comp.flac
+KEY_PATTERN = re.compile(r"^([0-9a-f]{32})[._]")
+
+def get_audio_hash(mix_path, model_name, target, blocksize=65536):
+    """
+    Returns the hex digest of the decoded audio, the model and the target
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{model_name}\0{target}\0".encode())
+    with sf.SoundFile(mix_path) as mix:
+        h.update(f"{mix.samplerate}\0{mix.channels}\0".encode())
+        for block in mix.blocks(blocksize=blocksize, dtype="int32", always_2d=True):
+            h.update(block.tobytes())
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    Separation results kept by a StorageManager, one folder by entry
+
+    extension: the format of the stored files, flac or wav
+    """
+    def __init__(self, storage, extension="flac"):
+        self.storage = storage
+        self.extension = extension
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, mix_path, model_name, targets):
+        return get_audio_hash(mix_path, model_name, "+".join(targets))
+
+    def paths(self, key, targets):
+        """
+        Returns the path of the mix and the paths of the sources {source: path} of the entry,
+        the targets and the accompaniment
+        """
+        entry_folder = self.storage.entry_folder(key)
+        sources = {target: entry_folder.joinpath(f"{key}_{target}.{self.extension}") for target in targets}
+        sources["accompaniment"] = entry_folder.joinpath(f"{key}_comp.{self.extension}")
+        return entry_folder.joinpath(f"{key}.{self.extension}"), sources
+
+    def get(self, key, targets):
+        """
+        Returns the paths of the entry if the results are stored, None otherwise
+        """
+        paths = self.paths(key, targets)
+        hit = paths[0].exists() and all(p.exists() for p in paths[1].values())
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not hit:
+            return None
+        # the access time orders the entries for the eviction
+        self.storage.touch(key)
+        return paths
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
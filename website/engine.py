@@ -0,0 +1,220 @@
+"""
+CPU inference engine
+
+The magnitude spectrograms of the windows sent by the concurrent separations of a process
+are batched in one forward pass of the model: a batch is run when max_batch_size windows
+are waiting or max_wait seconds after its first window. The windows of different lengths
+(the short clips, the last windows of the mixes) are padded with zero frames to the longest
+window they are batched with, up to settings["max_padding"] of its frames, the longer
+paddings run in separate batches. A window running alone is never padded.
+The engines look the models up in the registry for each batch, its LRU eviction applies.
+The number of torch threads is set from the number of cores and of workers.
+The models of the targets of a separation run on the STFT of the mix computed once,
+batched or not, settings["target_workers"] of them at the same time
+"""
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import torch
+from registry import registry, preload
+
+logger = logging.getLogger(__name__)
+
+# batching of the forward passes, disabled when max_batch_size is 1
+# max_padding: the fraction of padded frames of a window in a batch, 0 to batch the windows of the same length only
+# target_workers: the models of the targets running at the same time
+settings = {"max_batch_size": 1, "max_wait": 0.02, "max_padding": 0.25, "target_workers": 1}
+
+def get_thread_counts(nb_workers=1, nb_cores=None):
+    """
+    Returns the number of intra-op and inter-op threads of each worker
+
+    The cores are shared between the workers, the model being a sequence of
+    layers there is little to run in parallel between the ops
+    """
+    if nb_cores is None:
+        nb_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    intra = max(1, nb_cores // nb_workers)
+    inter = 2 if intra >= 8 else 1
+    return intra, inter
+
+def configure_threads(nb_workers=1, nb_cores=None):
+    """
+    Sets the torch threads of the current process
+
+    The models of the targets run in parallel when there are inter-op threads to spare
+    """
+    intra, inter = get_thread_counts(nb_workers, nb_cores)
+    settings["target_workers"] = inter
+    torch.set_num_threads(intra)
+    try:
+        torch.set_num_interop_threads(inter)
+    except RuntimeError:
+        # the inter-op pool is already started, it keeps its size
+        pass
+    logger.info("Using %d intra-op and %d inter-op threads", intra, inter)
+    return intra, inter
+
+def init_worker(nb_workers, model_name, targets, device="cpu", max_models=None):
+    """
+    Initializer of the worker processes: sets the threads and loads the models
+    """
+    configure_threads(nb_workers)
+    preload(model_name, targets, device, max_models)
+
+class BatchingEngine:
+    """
+    Runs the forward passes of the spectrogram view of the model of a target on batches of windows
+
+    max_batch_size: the maximum number of windows in a forward pass
+    max_wait: the time the first window of a batch waits for others (seconds)
+    max_padding: the fraction of the frames of the longest window of a batch that can be padding
+    """
+    def __init__(self, model_name, target, device="cpu", max_batch_size=8, max_wait=0.02, max_padding=0.25):
+        self.model_name = model_name
+        self.target = target
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_padding = max_padding
+        self.requests = queue.Queue()
+        self.nb_batches = 0
+        self.nb_windows = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def forward(self, spectrogram):
+        """
+        Returns the magnitude estimate of the target (nb_frames, nb_channels, nb_bins)
+
+        spectrogram: the magnitude spectrogram of the window (nb_frames, 1, nb_channels, nb_bins)
+        """
+        future = Future()
+        self.requests.put((spectrogram, future))
+        return future.result()
+
+    def stats(self):
+        return {
+            "batches": self.nb_batches,
+            "windows": self.nb_windows,
+            "mean_batch_size": self.nb_windows / self.nb_batches if self.nb_batches else 0.0,
+        }
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            # waiting for the windows of the other separations
+            try:
+                while len(batch) < self.max_batch_size:
+                    batch.append(self.requests.get(timeout=self.max_wait))
+            except queue.Empty:
+                pass
+
+            # padding changes the estimates, only the windows of close lengths are batched together
+            groups = {}
+            for spectrogram, future in batch:
+                groups.setdefault(tuple(spectrogram.shape[1:]), []).append((spectrogram, future))
+            groups = [group for windows in groups.values() for group in group_by_length(windows, self.max_padding)]
+
+            for group in groups:
+                try:
+                    estimates = self._forward_batch([spectrogram for spectrogram, _ in group])
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+
+                for (_, future), Vj in zip(group, estimates):
+                    future.set_result(Vj)
+
+    def _forward_batch(self, spectrograms):
+        """
+        Returns the estimates of the spectrograms of windows, padded to the longest one
+        """
+        lengths = [len(spectrogram) for spectrogram in spectrograms]
+        nb_frames = max(lengths)
+        # the samples are the second dimension of the spectrograms, the frames the first one
+        batch = torch.cat([
+            torch.nn.functional.pad(spectrogram, (0, 0, 0, 0, 0, 0, 0, nb_frames - len(spectrogram)))
+            if len(spectrogram) < nb_frames else spectrogram
+            for spectrogram in spectrograms
+        ], dim=1)
+
+        # not kept by the engine, the model may have been evicted and loaded again
+        view = registry.get_view(self.model_name, self.target, self.device)
+        with torch.no_grad():
+            V = view(batch.to(self.device)).cpu().numpy()
+
+        self.nb_batches += 1
+        self.nb_windows += len(spectrograms)
+
+        # output is nb_frames, nb_samples, nb_channels, nb_bins, the padding is cropped
+        return [V[:length, i] for i, length in enumerate(lengths)]
+
+def group_by_length(windows, max_padding):
+    """
+    Returns the groups of the windows [(spectrogram, future)] batched together, the windows of a group
+    are at least (1 - max_padding) times as long as the longest one
+    """
+    groups = []
+    for window in sorted(windows, key=lambda w: len(w[0]), reverse=True):
+        if groups and len(window[0]) >= (1 - max_padding) * len(groups[-1][0][0]):
+            groups[-1].append(window)
+        else:
+            groups.append([window])
+    return groups
+
+# the engines of the current process {(model_name, target, device): engine}
+engines = {}
+engines_lock = threading.Lock()
+
+def get_engine(model_name, target, device="cpu"):
+    key = (str(model_name), target, device)
+    with engines_lock:
+        if key not in engines:
+            engines[key] = BatchingEngine(model_name, target, device,
+                                          settings["max_batch_size"], settings["max_wait"], settings["max_padding"])
+        return engines[key]
+
+def forward_spectrogram(stft_f, model_name, target, device="cpu"):
+    """
+    Returns the magnitude estimate of the target (nb_frames, nb_channels, nb_bins)
+
+    stft_f: the STFT of the window computed by the model (1, nb_channels, nb_bins, nb_frames, 2)
+    The spectrogram of the window is batched with the windows of the concurrent separations
+    when the batching is enabled
+    """
+    view = registry.get_view(model_name, target, device)
+    with torch.no_grad():
+        spectrogram = view.spec(stft_f)
+    if settings["max_batch_size"] > 1:
+        return get_engine(model_name, target, device).forward(spectrogram)
+
+    with torch.no_grad():
+        return view(spectrogram).cpu().numpy()[:, 0, ...]
+
+# the threads running the models of the targets of a separation
+target_executor = None
+target_executor_lock = threading.Lock()
+
+def get_target_executor():
+    global target_executor
+    with target_executor_lock:
+        if target_executor is None:
+            target_executor = ThreadPoolExecutor(settings["target_workers"])
+        return target_executor
+
+def forward_targets(stft_f, model_name, targets, device="cpu"):
+    """
+    Returns the magnitude estimates of the targets
+
+    The models run on the shared STFT of the window, batched with the concurrent
+    separations when the batching is enabled
+    """
+    run = lambda target: forward_spectrogram(stft_f, model_name, target, device)
+
+    if len(targets) == 1 or settings["target_workers"] <= 1:
+        return [run(target) for target in targets]
+    return list(get_target_executor().map(run, targets))
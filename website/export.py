@@ -0,0 +1,172 @@
+"""
+Export of a trained model for the CPU serving
+
+The LSTM and linear layers of the model are quantized to int8 (dynamic quantization),
+the quantized model is written to the output folder which can be used as MODEL_NAME
+by the app. The export is checked on the tracks of the valid split: the SDR of the
+target and of the accompaniment and the separation time of the quantized model are
+compared with the ones of the float model, the report is written in the json of the export.
+
+    python export.py --model /path/to/model --output /path/to/export --root /path/to/data --max-sdr-drop 0.5
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import soundfile as sf
+import torch
+from test import load_model
+from registry import registry, get_exported_paths, quantize_model
+from engine import configure_threads
+from separation import separate
+from metrics import Trace
+
+target_instrument = "acoustic_guitar"
+
+def export_model(model_name, target, output_folder: Path, device="cpu"):
+    """
+    Writes the quantized model of the target in output_folder, returns the path of its weights
+
+    The json of the float model is copied with the parameters of the export
+    """
+    unmix = load_model(target=target, model_name=str(model_name), device=device)
+    quantized = quantize_model(unmix)
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+    json_path, weights_path = get_exported_paths(output_folder, target)
+    params = json.loads(Path(str(model_name), f"{target}.json").read_text())
+    params["export"] = {
+        "source": str(model_name),
+        "quantization": "int8 dynamic (LSTM, Linear)",
+        "max_bin": int(unmix.nb_bins),
+        "sample_rate": int(unmix.sample_rate),
+        "torch": torch.__version__,
+    }
+    torch.save(quantized.state_dict(), weights_path)
+    json_path.write_text(json.dumps(params, indent=2))
+    return weights_path
+
+def get_sdr(reference, estimate, eps=1e-8):
+    """
+    Returns the signal to distortion ratio of the estimate (dB)
+    """
+    length = min(len(reference), len(estimate))
+    reference, estimate = reference[:length].astype(np.float64), estimate[:length].astype(np.float64)
+    return 10 * np.log10((np.sum(reference ** 2) + eps) / (np.sum((reference - estimate) ** 2) + eps))
+
+def load_valid_tracks(root: Path, target_file, duration=30.0, max_tracks=None):
+    """
+    Yields the name, the mix and the target of the tracks of the valid split, int16 scaled like the uploads
+
+    The mix is the sum of the stems of the track, cropped to its first duration seconds (0 for the whole track)
+    """
+    track_folders = sorted(f for f in root.joinpath("valid").iterdir() if f.joinpath(target_file).exists())
+    for track_folder in track_folders[:max_tracks]:
+        stems = {}
+        for stem_path in sorted(track_folder.glob("*.wav")):
+            info = sf.info(str(stem_path))
+            frames = int(duration * info.samplerate) if duration else -1
+            stems[stem_path.name], _ = sf.read(str(stem_path), frames=frames, dtype="float32", always_2d=True)
+        length = min(len(stem) for stem in stems.values())
+        mix = sum(stem[:length] for stem in stems.values())
+        yield track_folder.name, mix * 32768, stems[target_file][:length] * 32768
+
+def evaluate(model_name, target, tracks, device="cpu") -> dict:
+    """
+    Returns the median SDR of the target and of the accompaniment, the separation time
+    and the time of the forward passes of the model on the tracks [(name, mix, target)]
+    """
+    if not tracks:
+        raise ValueError(f"No track to evaluate the {target} model on")
+    sdr = {target: [], "accompaniment": []}
+    trace = Trace()
+    seconds, audio_seconds = 0.0, 0.0
+    rate = int(registry.get(model_name, target, device).sample_rate)
+    # the first forward pass allocates the buffers of the layers, it is not timed
+    separate(tracks[0][1][:rate], [target], model_name, device)
+    for name, mix, reference in tracks:
+        start = perf_counter()
+        estimates = separate(mix, [target], model_name, device, trace=trace)
+        seconds += perf_counter() - start
+        audio_seconds += len(mix) / rate
+
+        references = {target: reference, "accompaniment": mix - reference}
+        for source in sdr:
+            sdr[source].append(get_sdr(references[source], estimates[source].reshape(-1, mix.shape[1])))
+
+    return {
+        "sdr": {source: float(np.median(values)) for source, values in sdr.items()},
+        "seconds": seconds,
+        "inference_seconds": trace.stages["inference"]["seconds"],
+        "rtf": seconds / audio_seconds,
+    }
+
+def get_report(model_name, export_folder, target, tracks, device="cpu") -> dict:
+    """
+    Returns the evaluation of the float and of the exported models, the SDR drop and the speedup
+    """
+    report = {
+        "float": evaluate(model_name, target, tracks, device),
+        "exported": evaluate(export_folder, target, tracks, device),
+        "weights_mb": {
+            "float": next(Path(str(model_name)).glob(f"{target}*.pth")).stat().st_size / 1e6,
+            "exported": get_exported_paths(export_folder, target)[1].stat().st_size / 1e6,
+        },
+        "nb_tracks": len(tracks),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+    report["sdr_drop"] = {source: report["float"]["sdr"][source] - report["exported"]["sdr"][source]
+                          for source in report["float"]["sdr"]}
+    report["speedup"] = report["float"]["seconds"] / report["exported"]["seconds"]
+    report["inference_speedup"] = report["float"]["inference_seconds"] / report["exported"]["inference_seconds"]
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantized export of a trained model")
+    parser.add_argument("--model", type=Path, required=True, help="folder of the trained model")
+    parser.add_argument("--output", type=Path, required=True, help="folder of the exported model")
+    parser.add_argument("--target", default=target_instrument)
+    parser.add_argument("--root", type=Path, help="folder of the train/valid split folders, the export is not checked without it")
+    parser.add_argument("--target-file", help="file of the target in the track folders, {target}.wav by default")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of each track evaluated, 0 for the whole tracks")
+    parser.add_argument("--max-tracks", type=int, help="number of valid tracks evaluated")
+    parser.add_argument("--max-sdr-drop", type=float, help="fails when the SDR of the target drops more (dB)")
+    parser.add_argument("--nb-workers", type=int, default=1, help="separation workers of the app, the cores are shared like in the app")
+    args = parser.parse_args()
+    # the checkpoints of the model folder are found by their prefix, the export needs its own folder
+    if args.output.resolve() == args.model.resolve():
+        parser.error("The output folder must differ from the model folder")
+
+    weights_path = export_model(args.model, args.target, args.output)
+    print(f"Exported the quantized {args.target} model to {weights_path}")
+    if args.root is None:
+        sys.exit()
+
+    configure_threads(nb_workers=args.nb_workers)
+    target_file = args.target_file or f"{args.target}.wav"
+    tracks = list(load_valid_tracks(args.root, target_file, args.duration, args.max_tracks))
+    if not tracks:
+        parser.error(f"No track of {args.root.joinpath('valid')} has a {target_file} stem, the export is not checked")
+    report = get_report(args.model, args.output, args.target, tracks)
+
+    json_path = get_exported_paths(args.output, args.target)[0]
+    params = json.loads(json_path.read_text())
+    params["export"]["report"] = report
+    json_path.write_text(json.dumps(params, indent=2))
+
+    for name in ("float", "exported"):
+        r = report[name]
+        print(f"{name}: SDR {args.target} {r['sdr'][args.target]:.2f} dB, accompaniment {r['sdr']['accompaniment']:.2f} dB, "
+              f"{r['seconds']:.1f}s (RTF {r['rtf']:.3f}) of which {r['inference_seconds']:.1f}s of inference, "
+              f"{report['weights_mb'][name]:.1f} MB of weights")
+    print(f"SDR drop {report['sdr_drop'][args.target]:+.2f} dB, speedup x{report['speedup']:.2f} "
+          f"(inference x{report['inference_speedup']:.2f}) on {len(tracks)} tracks")
+
+    if args.max_sdr_drop is not None and report["sdr_drop"][args.target] > args.max_sdr_drop:
+        print(f"The SDR of the {args.target} drops more than {args.max_sdr_drop} dB")
+        sys.exit(1)
@@ -0,0 +1,131 @@
+"""
+Streaming ingest of the uploads
+
+The uploaded file is received in memory instead of a temporary file. As soon as
+its first bytes are received the header is decoded: a file without the magic bytes
+of a supported format is refused (415), a mix longer than the maximum duration is
+refused (413) before the rest of the body is received. The files whose header can't
+be decoded from the first bytes (large metadata, e.g. cover art) are checked once
+received. The body size is limited by MAX_CONTENT_LENGTH.
+WAV, FLAC and OGG are decoded by soundfile, the mix and the results are
+stored in the output format (FLAC by default)
+"""
+import io
+import struct
+from os import replace
+from pathlib import Path
+import soundfile as sf
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+# soundfile formats of the accepted uploads
+ALLOWED_FORMATS = {"wav": "WAV", "flac": "FLAC", "ogg": "OGG"}
+MIMETYPES = {"wav": "audio/wav", "flac": "audio/flac", "ogg": "audio/ogg"}
+
+# bytes received before decoding the header
+HEADER_BYTES = 64 * 1024
+
+# magic bytes of the accepted formats {format: [(offset, bytes)]}
+MAGIC_BYTES = {
+    "WAV": [(0, b"RIFF"), (8, b"WAVE")],
+    "FLAC": [(0, b"fLaC")],
+    "OGG": [(0, b"OggS")],
+}
+
+# the maximum duration of the uploads (seconds), 0 for no limit
+max_duration = 0
+
+def get_wav_frames(buffer: bytes):
+    """
+    Returns the number of frames announced by the data chunk of the WAV header,
+    None if it is not found in the buffer or unknown (streamed WAV files)
+
+    soundfile only counts the frames of the data received
+    """
+    if buffer[:4] != b"RIFF" or buffer[8:12] != b"WAVE":
+        return None
+    offset, block_align = 12, None
+    while offset + 8 <= len(buffer):
+        chunk_id, size = struct.unpack_from("<4sI", buffer, offset)
+        if chunk_id == b"fmt " and offset + 22 <= len(buffer):
+            block_align = struct.unpack_from("<H", buffer, offset + 20)[0]
+        elif chunk_id == b"data":
+            if not block_align or size in (0, 0xFFFFFFFF):
+                return None
+            return size // block_align
+        # the chunks are padded to an even size
+        offset += 8 + size + size % 2
+    return None
+
+def get_magic_format(buffer: bytes):
+    """
+    Returns the format announced by the magic bytes of the file, None if not an accepted format
+    """
+    for name, magic in MAGIC_BYTES.items():
+        if all(buffer[offset:offset + len(value)] == value for offset, value in magic):
+            return name
+    return None
+
+def check_header(buffer: bytes, final=False):
+    """
+    Returns the info of the audio header, raises UnsupportedMediaType if it can't be decoded
+    and RequestEntityTooLarge if the mix is longer than max_duration
+
+    final: the buffer is the whole file, the duration of the OGG files is only known then,
+    otherwise only the magic bytes are required and None is returned if the header can't be decoded yet
+    """
+    if get_magic_format(buffer) is None:
+        raise UnsupportedMediaType("The file is not a WAV, FLAC or OGG audio file")
+    try:
+        info = sf.info(io.BytesIO(buffer))
+    except RuntimeError:
+        if not final:
+            return None
+        raise UnsupportedMediaType("The file is not a WAV, FLAC or OGG audio file")
+    if info.format not in ALLOWED_FORMATS.values():
+        raise UnsupportedMediaType(f"The {info.format} format is not supported")
+
+    frames = info.frames
+    if info.format == "WAV" and not final:
+        frames = get_wav_frames(buffer) or frames
+    if max_duration and (final or info.format != "OGG") and frames / info.samplerate > max_duration:
+        raise RequestEntityTooLarge(f"The mix is longer than {max_duration}s")
+    return info
+
+class IngestBuffer(io.BytesIO):
+    """
+    In memory upload, the header is checked once HEADER_BYTES are received
+    """
+    def __init__(self):
+        super().__init__()
+        self.checked = False
+
+    def write(self, data):
+        n = super().write(data)
+        if not self.checked and self.tell() >= HEADER_BYTES:
+            self.checked = True
+            check_header(self.getvalue())
+        return n
+
+class IngestRequest(Request):
+    """
+    Request receiving the uploaded files in an IngestBuffer
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return IngestBuffer()
+
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_FORMATS
+
+def store_mix(stream, mix_path: Path, blocksize=65536):
+    """
+    Writes the decoded upload in the format of mix_path (int16), under a hidden name renamed once complete
+    """
+    stream.seek(0)
+    part_path = mix_path.with_name(f".{mix_path.name}")
+    with sf.SoundFile(stream) as mix:
+        with sf.SoundFile(str(part_path), "w", samplerate=mix.samplerate, channels=mix.channels, subtype="PCM_16") as output:
+            for block in mix.blocks(blocksize=blocksize, dtype="int16", always_2d=True):
+                output.write(block)
+    replace(part_path, mix_path)
@@ -0,0 +1,151 @@
+"""
+Separation jobs queue
+
+The upload handler submits a job and returns its id at once, a bounded pool of
+worker processes separates the mixes in the background.
+The jobs and their status are kept by a queue backend, LocalBackend keeps them
+in memory so the app and the tests don't need any outside service
+"""
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+from uuid import uuid4
+
+class QueueFull(Exception):
+    """
+    Raised when the number of pending jobs reached the maximum depth
+    """
+
+class LocalBackend:
+    """
+    In memory queue backend, a stand-in for a shared queue service
+
+    max_history: number of finished jobs status kept
+    """
+    def __init__(self, max_history=1000):
+        self.pending = queue.Queue()
+        self.jobs = OrderedDict()
+        self.max_history = max_history
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def put(self, job_id, payload, context):
+        with self.lock:
+            self.jobs[job_id] = {"state": "queued", "submitted": time(), "context": context}
+            self.active += 1
+        self.pending.put((job_id, payload))
+
+    def get(self, timeout=None):
+        """
+        Returns the next (job_id, payload) or None after timeout seconds
+        """
+        try:
+            return self.pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def set_status(self, job_id, **fields):
+        with self.lock:
+            status = self.jobs[job_id]
+            if fields.get("state") in ("done", "failed") and status["state"] not in ("done", "failed"):
+                self.active -= 1
+            status.update(fields)
+
+            # forgetting the oldest finished jobs
+            while len(self.jobs) > self.max_history:
+                oldest_id, oldest = next(iter(self.jobs.items()))
+                if oldest["state"] not in ("done", "failed"):
+                    break
+                del self.jobs[oldest_id]
+
+    def get_status(self, job_id):
+        with self.lock:
+            status = self.jobs.get(job_id)
+            return dict(status) if status is not None else None
+
+    def depth(self):
+        """
+        Returns the number of queued and running jobs
+        """
+        with self.lock:
+            return self.active
+
+class JobQueue:
+    """
+    Dispatches the queued jobs to a pool of workers
+
+    worker: a picklable function called with the job payload as keyword arguments
+    nb_workers: the number of jobs running at the same time
+    max_depth: the maximum number of queued and running jobs
+    executor: the pool running the jobs, worker processes by default
+    on_done: called with the job id and its status when a job is done or failed
+    """
+    def __init__(self, worker, backend=None, nb_workers=2, max_depth=16, executor=None, on_done=None):
+        self.worker = worker
+        self.on_done = on_done
+        self.backend = backend if backend is not None else LocalBackend()
+        self.max_depth = max_depth
+        self.executor = executor if executor is not None else ProcessPoolExecutor(nb_workers)
+        self.slots = threading.Semaphore(nb_workers)
+        self.submit_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, payload, context=None):
+        """
+        Queues a job and returns its id
+
+        context: data kept with the job status, e.g. to display the results
+        """
+        with self.submit_lock:
+            if self.backend.depth() >= self.max_depth:
+                raise QueueFull(f"{self.max_depth} jobs are already pending")
+            job_id = uuid4().hex
+            self.backend.put(job_id, payload, context or {})
+        return job_id
+
+    def status(self, job_id):
+        """
+        Returns the status of the job, None if the job is unknown
+        """
+        return self.backend.get_status(job_id)
+
+    def shutdown(self, wait=True):
+        self.stopped.set()
+        self.dispatcher.join()
+        self.executor.shutdown(wait=wait)
+
+    def _dispatch(self):
+        while not self.stopped.is_set():
+            # waiting for a free worker before pulling a job
+            if not self.slots.acquire(timeout=0.5):
+                continue
+            item = self.backend.get(timeout=0.5)
+            if item is None:
+                self.slots.release()
+                continue
+
+            job_id, payload = item
+            self.backend.set_status(job_id, state="running", started=time())
+            try:
+                future = self.executor.submit(self.worker, **payload)
+            except Exception as e:
+                self.slots.release()
+                self.backend.set_status(job_id, state="failed", error=str(e), finished=time())
+                if self.on_done is not None:
+                    self.on_done(job_id, self.backend.get_status(job_id))
+                continue
+            future.add_done_callback(lambda f, job_id=job_id: self._done(job_id, f))
+
+    def _done(self, job_id, future):
+        self.slots.release()
+        error = future.exception()
+        if error is not None:
+            self.backend.set_status(job_id, state="failed", error=str(error), finished=time())
+        else:
+            self.backend.set_status(job_id, state="done", result=future.result(), finished=time())
+        if self.on_done is not None:
+            self.on_done(job_id, self.backend.get_status(job_id))
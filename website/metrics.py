@@ -0,0 +1,135 @@
+"""
+Metrics of the web app
+
+Counters, gauges and histograms kept in memory and exposed in the Prometheus
+text format by the /metrics route. A Trace records the time and the bytes of
+the stages of a request or of a separation job, the job traces are returned by
+the worker processes with the job result. The traces are also logged when
+TRACE_REQUESTS is set
+"""
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from os import environ
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# logging of the trace of each request and job
+trace_requests = bool(environ.get("TRACE_REQUESTS"))
+
+# upper bounds of the histograms buckets (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class Metrics:
+    """
+    Registry of the metrics of the process
+
+    The series are keyed by their name and their labels
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (series_name, labels), value in sorted(series.items()):
+                        if series_name == name:
+                            lines.append(f"{name}{format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (series_name, labels), histogram in sorted(self.histograms.items()):
+                    if series_name != name:
+                        continue
+                    for bound, count in zip(self.buckets, histogram["buckets"]):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+class Trace:
+    """
+    Time, bytes and number of calls of the stages of a request or of a job
+    """
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, nb_bytes=0):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start, nb_bytes)
+
+    def add(self, name, seconds, nb_bytes=0):
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "bytes": 0, "count": 0})
+        stage["seconds"] += seconds
+        stage["bytes"] += nb_bytes
+        stage["count"] += 1
+
+    def add_bytes(self, name, nb_bytes):
+        """
+        Adds the bytes of a stage known once it ran
+        """
+        self.stages[name]["bytes"] += nb_bytes
+
+    def as_dict(self):
+        return {name: dict(stage) for name, stage in self.stages.items()}
+
+def record_trace(stages, kind, **context):
+    """
+    Records the stages of a trace in the metrics, and logs the trace if trace_requests
+
+    stages: the dict of a Trace (as_dict)
+    kind: upload or job
+    """
+    for name, stage in stages.items():
+        metrics.observe("separation_stage_seconds", stage["seconds"], kind=kind, stage=name)
+        if stage["bytes"]:
+            metrics.inc("separation_stage_bytes_total", stage["bytes"], kind=kind, stage=name)
+    if trace_requests:
+        logger.info("trace %s", json.dumps(dict(kind=kind, stages=stages, **context), default=str))
+
+# the metrics of the app process
+metrics = Metrics()
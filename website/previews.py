@@ -0,0 +1,64 @@
+"""
+Compressed preview variants of the separation results
+
+A variant is encoded on its first request, next to the result in the folder of its
+entry ({name}.{variant}.{extension}), and then served from the disk. The variants are
+evicted with the cache entry
+"""
+import threading
+from os import replace
+from pathlib import Path
+import soundfile as sf
+
+# soundfile formats of the variants, the compression level trades quality for size
+VARIANTS = {
+    "preview": {"format": "OGG", "subtype": "VORBIS", "extension": "ogg", "mimetype": "audio/ogg",
+                "compression_level": 0.6},
+}
+
+# one lock by variant file, the concurrent requests wait for the first encoding
+locks = {}
+locks_lock = threading.Lock()
+
+def get_variant_path(result_path: Path, variant) -> Path:
+    return result_path.with_name(f"{result_path.stem}.{variant}.{VARIANTS[variant]['extension']}")
+
+def is_variant(path: Path) -> bool:
+    """
+    Returns True if the file is a variant of a result, its variants are not encoded
+    """
+    return any(path.name.endswith(f".{variant}.{params['extension']}") for variant, params in VARIANTS.items())
+
+def encode_variant(result_path: Path, variant_path: Path, variant, blocksize=65536):
+    """
+    Encodes the result in the variant format, under a hidden name renamed once complete
+    """
+    params = VARIANTS[variant]
+    part_path = variant_path.with_name(f".{variant_path.name}")
+    with sf.SoundFile(str(result_path)) as result:
+        with sf.SoundFile(str(part_path), "w", samplerate=result.samplerate, channels=result.channels,
+                          format=params["format"], subtype=params["subtype"],
+                          compression_level=params["compression_level"]) as output:
+            for block in result.blocks(blocksize=blocksize, dtype="float32", always_2d=True):
+                output.write(block)
+    replace(part_path, variant_path)
+
+def get_variant(result_path: Path, variant):
+    """
+    Returns the path of the variant of the result and True if it was encoded by this call
+
+    Raises KeyError for an unknown variant
+    """
+    variant_path = get_variant_path(result_path, variant)
+    if variant_path.exists():
+        return variant_path, False
+
+    with locks_lock:
+        lock = locks.setdefault(variant_path, threading.Lock())
+    with lock:
+        encoded = not variant_path.exists()
+        if encoded:
+            encode_variant(result_path, variant_path, variant)
+    with locks_lock:
+        locks.pop(variant_path, None)
+    return variant_path, encoded
@@ -0,0 +1,178 @@
+"""
+Process-wide registry of the Open-Unmix models
+
+Each (model_name, target, device) is loaded once and stays resident,
+the least recently used model is evicted when more than max_models are loaded.
+model_name is the folder of the trained models, or of the quantized models
+written by export.py
+"""
+import copy
+import json
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from time import perf_counter
+import torch
+from test import load_model
+from model import NoOp, OpenUnmix
+
+logger = logging.getLogger(__name__)
+
+class ModelRegistry:
+    """
+    LRU cache of the loaded models
+
+    max_models: the number of models kept in memory
+    """
+    def __init__(self, max_models=2):
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.views = {}
+        self.load_times = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, model_name, target, device="cpu"):
+        """
+        Returns the model of the target, loading it on first use
+        """
+        key = (str(model_name), target, device)
+        with self.lock:
+            if key in self.models:
+                self.hits += 1
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            self.misses += 1
+            start = perf_counter()
+            unmix = load_serving_model(target, model_name, device)
+            self.load_times[key] = perf_counter() - start
+            logger.info("Loaded %s model from %s on %s in %.2fs", target, model_name, device, self.load_times[key])
+
+            self.models[key] = unmix
+            while len(self.models) > self.max_models:
+                evicted, _ = self.models.popitem(last=False)
+                self.views.pop(evicted, None)
+                logger.info("Evicted %s model from %s on %s", evicted[1], evicted[0], evicted[2])
+
+            return unmix
+
+    def put(self, model_name, target, unmix, device="cpu"):
+        """
+        Registers an already built model, e.g. a model with random weights
+        """
+        with self.lock:
+            key = (str(model_name), target, device)
+            self.models[key] = unmix
+            self.models.move_to_end(key)
+            self.views.pop(key, None)
+            while len(self.models) > self.max_models:
+                evicted, _ = self.models.popitem(last=False)
+                self.views.pop(evicted, None)
+
+    def get_view(self, model_name, target, device="cpu"):
+        """
+        Returns the spectrogram view of the model of the target, see spectrogram_view
+        """
+        unmix = self.get(model_name, target, device)
+        key = (str(model_name), target, device)
+        with self.lock:
+            # the view of a model evicted and loaded again is rebuilt
+            if key not in self.views or self.views[key][0] is not unmix:
+                self.views[key] = (unmix, spectrogram_view(unmix))
+            return self.views[key][1]
+
+    def stats(self):
+        """
+        Returns the cache hits, misses, hit rate and the load time of the models
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "loaded": [list(key) for key in self.models],
+                "load_times": {"/".join(key): t for key, t in self.load_times.items()},
+            }
+
+def quantize_model(unmix, inplace=False):
+    """
+    Returns the model with int8 dynamically quantized LSTM and linear layers, a copy unless inplace
+    """
+    return torch.quantization.quantize_dynamic(unmix, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8,
+                                               inplace=inplace)
+
+def get_exported_paths(model_name, target):
+    """
+    Returns the paths of the json and of the weights of the exported model of the target
+    """
+    return Path(str(model_name), f"{target}.json"), Path(str(model_name), f"{target}.quantized.pth")
+
+def get_torch_version():
+    """
+    Returns the (major, minor) version of torch
+    """
+    return tuple(int(v) for v in torch.__version__.split(".")[:2])
+
+def load_exported_model(target, model_name, device="cpu"):
+    """
+    Returns the quantized model of the target written by export.py
+
+    The quantized layers only run on the CPU
+    """
+    if device != "cpu":
+        raise ValueError(f"The quantized models run on the cpu, not on {device}")
+    json_path, weights_path = get_exported_paths(model_name, target)
+    params = json.loads(json_path.read_text())
+    unmix = OpenUnmix(n_fft=params["args"]["nfft"], n_hop=params["args"]["nhop"],
+                      nb_channels=params["args"]["nb_channels"], hidden_size=params["args"]["hidden_size"],
+                      max_bin=params["export"]["max_bin"], sample_rate=params["export"]["sample_rate"])
+    unmix.stft.center = True
+    unmix.eval()
+    quantize_model(unmix, inplace=True)
+    # the packed weights of the quantized layers are not plain tensors, torch < 1.13 loads them without weights_only
+    load_args = {"weights_only": False} if get_torch_version() >= (1, 13) else {}
+    unmix.load_state_dict(torch.load(weights_path, map_location=device, **load_args))
+    return unmix
+
+def load_serving_model(target, model_name, device="cpu"):
+    """
+    Returns the model of the target, the exported model if model_name is an export folder
+    """
+    if get_exported_paths(model_name, target)[1].exists():
+        return load_exported_model(target, model_name, device)
+    return load_model(target=target, model_name=str(model_name), device=device)
+
+def spectrogram_view(unmix):
+    """
+    Returns a shallow copy of the model taking the magnitude spectrogram of the mix as input
+
+    The copy shares the weights of the model, only its input transform is replaced,
+    so that the STFT of a mix is computed once for all the targets
+    """
+    view = copy.copy(unmix)
+    # the submodules are copied not to replace the transform of the model
+    view._modules = type(unmix._modules)(unmix._modules)
+    view.transform = NoOp()
+    return view
+
+# the registry of the current process
+registry = ModelRegistry()
+
+def preload(model_name, targets, device="cpu", max_models=None):
+    """
+    Loads the models of the targets in the registry of the current process
+
+    Used at startup and as initializer of the worker processes, a model failing
+    to load is logged and will be loaded again on first use
+    """
+    if max_models is not None:
+        registry.max_models = max_models
+    for target in targets:
+        try:
+            registry.get(model_name, target, device)
+        except Exception:
+            logger.exception("Could not preload the %s model from %s", target, model_name)
@@ -0,0 +1,213 @@
+"""
+Separation of the uploaded mix with the Open-Unmix model
+
+The mix can be separated at once or streamed by overlapping windows,
+the windows estimates are stitched with a linear crossfade.
+Several targets are separated in one pass: the STFT of the mix is shared by
+their models and their estimates are filtered together
+"""
+from os import getpid, replace
+from pathlib import Path
+import numpy as np
+import norbert
+import soundfile as sf
+import torch
+from test import istft
+from registry import registry
+from engine import forward_targets
+from metrics import Trace
+
+# streaming separation, duration of the windows and of their overlap (seconds)
+window_duration = 30
+overlap_duration = 2
+
+def to_int16(wav):
+    """
+    Returns the wav clipped to the int16 range
+    """
+    return np.clip(wav, -32768, 32767).astype("int16")
+
+def check_stft(unmixes):
+    """
+    Raises ValueError if the models don't share the STFT parameters, their
+    estimates of the same STFT are filtered together
+    """
+    params = {(u.stft.n_fft, u.stft.n_hop, u.stft.center, int(u.sample_rate)) for u in unmixes}
+    if len(params) > 1:
+        raise ValueError(f"The models of the targets must share their STFT parameters "
+                         f"(n_fft, n_hop, center, sample_rate), got {sorted(params)}")
+
+def separate(audio, targets, model_name, device="cpu", niter=1, trace=None, residual=True):
+    """
+    Returns the estimates of the targets, and of the accompaniment if residual
+
+    Same as open-unmix test.separate except that the models are kept in the registry
+    instead of being loaded at each call, the STFT of the mix is computed once for
+    the models of all the targets and the Wiener filter, and the forward passes may
+    be batched with the other separations of the process
+    trace: a Trace recording the STFT, the inference and the post-processing times
+    """
+    trace = trace or Trace()
+    audio_torch = torch.tensor(audio.T[None, ...]).float().to(device)
+
+    unmixes = [registry.get(model_name, target, device) for target in targets]
+    check_stft(unmixes)
+    unmix = unmixes[-1]
+    with trace.stage("stft"):
+        with torch.no_grad():
+            stft_f = unmix.stft(audio_torch)
+
+    # estimates are nb_frames, nb_channels, nb_bins
+    with trace.stage("inference"):
+        V = forward_targets(stft_f, model_name, targets, device)
+    V = np.transpose(np.array(V), (1, 3, 2, 0))
+
+    with trace.stage("postprocess"):
+        # convert to complex numpy type
+        X = stft_f.cpu().numpy()
+        X = X[..., 0] + X[..., 1]*1j
+        X = X[0].transpose(2, 1, 0)
+
+        source_names = list(targets)
+        if residual:
+            V = norbert.residual_model(V, X, 1)
+            source_names.append("accompaniment")
+
+        # joint multichannel Wiener filter of all the sources
+        Y = norbert.wiener(V, X.astype(np.complex128), niter, use_softmask=False)
+
+        estimates = {}
+        for j, name in enumerate(source_names):
+            audio_hat = istft(Y[..., j].T, n_fft=unmix.stft.n_fft, n_hopsize=unmix.stft.n_hop)
+            estimates[name] = audio_hat.T
+
+    return estimates
+
+def get_separate_wavs(mix_wav, targets, model_name, device="cpu", trace=None, residual=True):
+    """
+    Returns the separation of the mix {source: wav}, the targets and the accompaniment if residual
+    """
+    trace = trace or Trace()
+    estimates = separate(audio=mix_wav,
+        targets=targets,
+        model_name=model_name,
+        device=device,
+        trace=trace,
+        residual=residual)
+
+    with trace.stage("convert"):
+        return {name: to_int16(estimate.squeeze()) for name, estimate in estimates.items()}
+
+def get_separate_wav(mix_wav, target_instrument, model_name, device="cpu", trace=None):
+    """
+    Returns the separation of the mix
+    """
+    wavs = get_separate_wavs(mix_wav, [target_instrument], model_name, device, trace)
+    return wavs[target_instrument], wavs["accompaniment"]
+
+def get_window_starts(frames, window, overlap):
+    """
+    Returns the first frame of each window covering the mix
+
+    The windows are spaced by window - overlap frames, the last window
+    is the first one reaching the end of the mix
+    """
+    if overlap >= window:
+        raise ValueError(f"The overlap ({overlap}) must be shorter than the window ({window})")
+    return list(range(0, max(frames - overlap, 1), window - overlap))
+
+def separate_stream(mix_path, output_paths, targets, model_name, device="cpu",
+                    window_duration=window_duration, overlap_duration=overlap_duration, trace=None):
+    """
+    Separates the mix window by window and writes the sources
+
+    Only one window of the mix and of the estimates is in memory, the outputs are
+    written as soon as a window is separated, except its last overlap_duration seconds
+    which are crossfaded with the beginning of the next window
+    output_paths: {source: path} of the targets, and of the accompaniment
+    """
+    trace = trace or Trace()
+    names = list(output_paths)
+    with sf.SoundFile(mix_path) as mix:
+        rate, channels, frames = mix.samplerate, mix.channels, mix.frames
+        window = int(window_duration * rate)
+        overlap = int(overlap_duration * rate)
+        starts = get_window_starts(frames, window, overlap)
+
+        # fade in of the current window, the previous window fades out
+        fade_in = np.linspace(0, 1, overlap, endpoint=False)[:, None]
+
+        outputs = [
+            sf.SoundFile(output_paths[name], "w", samplerate=rate, channels=channels, subtype="PCM_16")
+            for name in names
+        ]
+        tails = [None] * len(names)
+        try:
+            for i, start in enumerate(starts):
+                with trace.stage("read"):
+                    mix.seek(start)
+                    mix_wav = mix.read(window, dtype="int16", always_2d=True)
+                trace.add_bytes("read", mix_wav.nbytes)
+                estimates = separate(audio=mix_wav,
+                    targets=targets,
+                    model_name=model_name,
+                    device=device,
+                    trace=trace,
+                    residual="accompaniment" in output_paths)
+
+                last = i == len(starts) - 1
+                for j, name in enumerate(names):
+                    # the istft may pad the estimate, cropping to the window length
+                    wav = estimates[name].reshape(-1, channels)[:len(mix_wav)]
+                    wav = np.pad(wav, ((0, len(mix_wav) - len(wav)), (0, 0)))
+
+                    if tails[j] is not None:
+                        wav[:overlap] = tails[j] * (1 - fade_in) + wav[:overlap] * fade_in
+
+                    with trace.stage("convert"):
+                        block = to_int16(wav if last else wav[:-overlap])
+                    with trace.stage("write", block.nbytes):
+                        outputs[j].write(block)
+                    if not last:
+                        tails[j] = wav[-overlap:]
+        finally:
+            for output in outputs:
+                output.close()
+
+    return rate
+
+def separate_file(mix_path, output_paths, targets, model_name, device="cpu",
+                  window_duration=window_duration, overlap_duration=overlap_duration):
+    """
+    Separates the mix file and writes the files of the sources
+
+    The files are written under a hidden name and renamed once complete, so they
+    are never read partially written
+    output_paths: {source: path} of the targets, and of the accompaniment
+    window_duration: 0 to separate the whole mix at once
+    Returns the sampling rate of the mix, the stages of the separation (see metrics.Trace)
+    and the models registry stats of the worker
+    """
+    trace = Trace()
+    output_paths = {name: Path(path) for name, path in output_paths.items()}
+    part_paths = {name: path.with_name(f".{path.name}") for name, path in output_paths.items()}
+
+    if window_duration > 0:
+        sr = separate_stream(mix_path, part_paths, targets, model_name, device,
+                             window_duration, overlap_duration, trace)
+    else:
+        with trace.stage("read"):
+            mix_wav, sr = sf.read(mix_path, dtype="int16", always_2d=True)
+        trace.add_bytes("read", mix_wav.nbytes)
+        wavs = get_separate_wavs(mix_wav, targets, model_name, device, trace,
+                                 residual="accompaniment" in output_paths)
+
+        # the format is given by the extension, wav or flac
+        with trace.stage("write", sum(wavs[name].nbytes for name in part_paths)):
+            for name, path in part_paths.items():
+                sf.write(path, wavs[name], sr, subtype="PCM_16")
+
+    for name, path in part_paths.items():
+        replace(path, output_paths[name])
+
+    return {"rate": sr, "stages": trace.as_dict(), "registry": registry.stats(), "pid": getpid()}
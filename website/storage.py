@@ -0,0 +1,207 @@
+"""
+Storage of the separation results
+
+Each cache entry has its own folder, sharded by the first characters of its key:
+{folder}/{key[:2]}/{key}/ holds the mix, the results and their previews, so that
+no folder grows with the number of entries. A SQLite index in the folder keeps
+the creation time, the last access time and the size of the entries.
+A background thread deletes the entries not accessed for max_age seconds, then
+the least recently accessed ones until the entries fit in max_bytes. The entries
+pinned (being stored or separated) are never deleted, each pin being released by its owner
+"""
+import os
+import shutil
+import sqlite3
+import threading
+from collections import Counter
+from pathlib import Path
+from time import time
+from cache import KEY_PATTERN
+
+# characters of the key naming the shard folders
+SHARD_CHARS = 2
+
+class StorageManager:
+    """
+    Per-entry folders of the results and their access index
+
+    max_bytes: the total size of the entries above which the least recently accessed ones are deleted
+    max_age: the seconds after the last access when an entry is deleted, 0 to keep them
+    interval: the seconds between two evictions of the background thread
+    """
+    def __init__(self, folder, max_bytes, max_age=0, interval=300):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self.pinned = Counter()
+        self.evicted_entries = 0
+        self.evicted_bytes = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.folder.joinpath("index.sqlite3")), timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries "
+                            "(key TEXT PRIMARY KEY, created REAL, accessed REAL, bytes INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    def entry_folder(self, key) -> Path:
+        return self.folder.joinpath(key[:SHARD_CHARS], key)
+
+    def path(self, name) -> Path:
+        """
+        Returns the path of a file of an entry from its name ({key}.flac, {key}_{target}.flac...),
+        None if the name doesn't start with a key
+        """
+        match = KEY_PATTERN.match(name)
+        if match is None:
+            return None
+        return self.entry_folder(match.group(1)).joinpath(name)
+
+    def create(self, key) -> Path:
+        """
+        Creates the folder of the entry if needed, returns it
+        """
+        entry_folder = self.entry_folder(key)
+        entry_folder.mkdir(parents=True, exist_ok=True)
+        now = time()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, 0)", (key, now, now))
+        return entry_folder
+
+    def update(self, key):
+        """
+        Records the size of the entry once files are added, and wakes the eviction if over max_bytes
+        """
+        size = get_folder_size(self.entry_folder(key))
+        with self.lock, self.db:
+            self.db.execute("UPDATE entries SET bytes = ? WHERE key = ?", (size, key))
+            total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        if total > self.max_bytes:
+            self.wake.set()
+
+    def touch(self, key):
+        with self.lock, self.db:
+            self.db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time(), key))
+
+    def pin(self, key):
+        with self.lock:
+            self.pinned[key] += 1
+
+    def unpin(self, key):
+        with self.lock:
+            if self.pinned[key] > 1:
+                self.pinned[key] -= 1
+            else:
+                self.pinned.pop(key, None)
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        # called with the lock held, the entry can't be pinned while its folder is deleted
+        shutil.rmtree(self.entry_folder(key), ignore_errors=True)
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def evict(self):
+        """
+        Deletes the entries not accessed for max_age, then the least recently accessed
+        until the entries fit in max_bytes
+
+        Returns the keys of the deleted entries
+        """
+        now = time()
+        with self.lock:
+            rows = self.db.execute("SELECT key, accessed, bytes FROM entries ORDER BY accessed").fetchall()
+
+        total = sum(size for _, _, size in rows)
+        evicted = []
+        for key, accessed, size in rows:
+            # the entries are sorted by access time, the next ones are more recent
+            if total <= self.max_bytes and not (self.max_age and now - accessed > self.max_age):
+                break
+            # an upload may have pinned the entry since the query
+            with self.lock:
+                if self.pinned[key]:
+                    continue
+                self._remove(key)
+            total -= size
+            evicted.append(key)
+            self.evicted_entries += 1
+            self.evicted_bytes += size
+        return evicted
+
+    def sync(self):
+        """
+        Indexes the entry folders missing from the index and forgets the entries without folder,
+        the files of the flat layout ({folder}/{key}.flac...) are moved to their entry folder
+        """
+        for f in os.scandir(self.folder):
+            if f.is_file() and KEY_PATTERN.match(f.name):
+                path = self.path(f.name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(f.path, path)
+
+        folders = {}
+        for shard in os.scandir(self.folder):
+            if shard.is_dir() and len(shard.name) == SHARD_CHARS:
+                for entry in os.scandir(shard.path):
+                    if entry.is_dir():
+                        folders[entry.name] = entry
+
+        with self.lock, self.db:
+            indexed = {key for key, in self.db.execute("SELECT key FROM entries")}
+            for key in indexed - folders.keys():
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            for key in folders.keys() - indexed:
+                mtime = folders[key].stat().st_mtime
+                self.db.execute("INSERT INTO entries VALUES (?, ?, ?, ?)",
+                                (key, mtime, mtime, get_folder_size(Path(folders[key].path))))
+
+    def usage(self):
+        with self.lock:
+            entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries").fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "pinned": len(self.pinned),
+            "evicted_entries": self.evicted_entries,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.evict()
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def start(self):
+        """
+        Indexes the existing entries and starts the eviction thread
+        """
+        self.sync()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+def get_folder_size(folder: Path):
+    """
+    Returns the size of the files of the folder, 0 if it doesn't exist
+    """
+    try:
+        return sum(f.stat().st_size for f in os.scandir(folder) if f.is_file())
+    except FileNotFoundError:
+        return 0
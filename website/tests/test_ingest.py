@@ -0,0 +1,69 @@
+"""
+Tests of the streaming header check of the uploads
+"""
+import io
+import struct
+import sys
+from pathlib import Path
+import pytest
+
+np = pytest.importorskip("numpy")
+sf = pytest.importorskip("soundfile")
+pytest.importorskip("flask")
+from werkzeug.exceptions import UnsupportedMediaType
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import ingest
+from ingest import HEADER_BYTES, IngestBuffer, check_header
+
+def make_flac(duration=1.0, samplerate=44100):
+    buffer = io.BytesIO()
+    audio = np.random.default_rng(0).normal(0, 0.1, (int(duration * samplerate), 2))
+    sf.write(buffer, audio, samplerate, format="FLAC", subtype="PCM_16")
+    return buffer.getvalue()
+
+def add_picture(flac: bytes, size: int) -> bytes:
+    """
+    Returns the FLAC file with a PICTURE metadata block of size bytes of image data after its STREAMINFO
+    """
+    data = bytes(size)
+    mime, description = b"image/jpeg", b""
+    picture = struct.pack(">II", 3, len(mime)) + mime + struct.pack(">I", len(description)) + description \
+        + struct.pack(">IIIII", 600, 600, 24, 0, len(data)) + data
+
+    # the STREAMINFO block is the first one, it is no longer the last block
+    header, streaminfo_length = flac[4], int.from_bytes(flac[5:8], "big")
+    end = 8 + streaminfo_length
+    last = header & 0x80
+    block = bytes([last | 6]) + len(picture).to_bytes(3, "big") + picture
+    return flac[:4] + bytes([header & 0x7F]) + flac[5:end] + block + flac[end:]
+
+def upload(content: bytes, chunk_size=16 * 1024):
+    buffer = IngestBuffer()
+    for i in range(0, len(content), chunk_size):
+        buffer.write(content[i:i + chunk_size])
+    return buffer
+
+def test_flac_with_large_picture_is_accepted():
+    flac = add_picture(make_flac(), 4 * HEADER_BYTES)
+    buffer = upload(flac)
+    info = check_header(buffer.getvalue(), final=True)
+    assert info.format == "FLAC"
+    assert info.frames == 44100
+
+def test_not_audio_is_refused_while_streaming():
+    with pytest.raises(UnsupportedMediaType):
+        upload(b"<html>" + bytes(2 * HEADER_BYTES))
+
+def test_undecodable_audio_is_refused_once_received():
+    content = b"fLaC" + bytes(2 * HEADER_BYTES)
+    buffer = upload(content)
+    with pytest.raises(UnsupportedMediaType):
+        check_header(buffer.getvalue(), final=True)
+
+def test_long_wav_is_refused_while_streaming(monkeypatch):
+    monkeypatch.setattr(ingest, "max_duration", 1)
+    wav = io.BytesIO()
+    sf.write(wav, np.zeros((10 * 8000, 1)), 8000, format="WAV", subtype="PCM_16")
+    with pytest.raises(ingest.RequestEntityTooLarge):
+        upload(wav.getvalue())